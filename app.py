@@ -1,18 +1,31 @@
 import os
+import re
 import uuid
-import json
 import time
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from markupsafe import Markup
-from models.indexer import index_documents
+import threading
+import mimetypes
+import hashlib
+import functools
+import shutil
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, abort
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from markupsafe import Markup, escape
+from models.indexer import index_documents, is_disk_index, open_disk_index
 from models.retriever import retrieve_documents
-from models.responder import generate_response
+from models.responder import generate_response, GenerationError
+from models import rag_cache
+from models.session_store import SessionStore
+from models.section_scan import parse_sections
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 
 from logger import get_logger
 from byaldi import RAGMultiModalModel
+from diskcache import Cache
 import markdown
+import torch
 from flask_login import LoginManager, UserMixin, UserMixin, login_user, login_required, logout_user, current_user
 
 # Set the TOKENIZERS_PARALLELISM environment variable to suppress warnings
@@ -38,12 +51,49 @@ logger = get_logger(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploaded_documents'
 app.config['STATIC_FOLDER'] = 'static'
 app.config['SESSION_FOLDER'] = 'sessions'
+app.config['SESSION_DB'] = os.path.join(app.config['SESSION_FOLDER'], 'sessions.db')
 app.config['INDEX_FOLDER'] = os.path.join(os.getcwd(), '.byaldi')  # Set to .byaldi folder in current directory
+app.config['SECTION_CACHE_FOLDER'] = os.path.join('cache', 'sections')
+# Deleted session folders are moved here and removed by a background janitor
+app.config['TRASH_FOLDER'] = os.path.join(os.getcwd(), '.trash')
+app.config['TRASH_SWEEP_INTERVAL'] = 60  # seconds
+# Public base URL of this app (e.g. https://rag.example.com). When set, GPT-4o gets
+# short-lived signed URLs to the retrieved images instead of base64 payloads.
+app.config['PUBLIC_BASE_URL'] = os.environ.get('PUBLIC_BASE_URL')
+app.config['SIGNED_IMAGE_MAX_AGE'] = 300  # seconds
+# Internal nginx location that aliases the static folder (e.g. /protected/static/).
+# When set, retrieved images are handed to nginx with X-Accel-Redirect and sent
+# with sendfile instead of being streamed through Python.
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
 
 # Create necessary directories if they don't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['STATIC_FOLDER'], exist_ok=True)
 os.makedirs(app.config['SESSION_FOLDER'], exist_ok=True)
+os.makedirs(app.config['TRASH_FOLDER'], exist_ok=True)
+
+# Chat sessions are stored in SQLite; legacy JSON session files are imported once
+session_store = SessionStore(app.config['SESSION_DB'])
+session_store.import_json_sessions(app.config['SESSION_FOLDER'])
+session_store.purge_deleted_sessions()
+
+SIDEBAR_CACHE_SECONDS = 5
+
+@functools.lru_cache(maxsize=64)
+def _cached_chat_sessions(user_id, time_bucket):
+    return session_store.list_sessions()
+
+def get_chat_sessions():
+    """
+    Returns the sidebar session list, cached for a few seconds per user.
+    """
+    return _cached_chat_sessions(current_user.get_id(), int(time.time() // SIDEBAR_CACHE_SECONDS))
+
+def invalidate_chat_sessions():
+    _cached_chat_sessions.cache_clear()
+
+# Parsed sections per document, keyed by (path, mtime, size) so edited files are re-parsed
+section_cache = Cache(app.config['SECTION_CACHE_FOLDER'])
 
 # **User Authentication Setup**
 
@@ -69,10 +119,41 @@ def load_user(user_id):
 # **Application Initialization**
 
 # Initialize global variables
-RAG_models = {}  # Dictionary to store RAG models per session
-app.config['INITIALIZATION_DONE'] = False  # Flag to track initialization
+# RAG models are loaded lazily and kept in an LRU, so memory is bounded by the
+# sessions in use rather than by every session ever created.
+RAG_MODELS_MAX = int(os.environ.get('RAG_MODELS_MAX', 4))
+RAG_models = OrderedDict()  # session_id -> RAG model, least recently used first
+RAG_models_lock = threading.Lock()
 logger.info("Application started.")
 
+def cache_rag_model(session_id, RAG):
+    """
+    Adds a RAG model to the LRU, evicting the least recently used models.
+    """
+    with RAG_models_lock:
+        RAG_models[session_id] = RAG
+        RAG_models.move_to_end(session_id)
+        evicted = []
+        while len(RAG_models) > RAG_MODELS_MAX:
+            evicted.append(RAG_models.popitem(last=False))
+    if evicted:
+        for victim_id, _ in evicted:
+            logger.info(f"Evicted RAG model for session {victim_id}.")
+        del evicted
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def get_rag_model(session_id):
+    """
+    Returns the RAG model for the session, loading it from disk on first use.
+    """
+    with RAG_models_lock:
+        RAG = RAG_models.get(session_id)
+        if RAG is not None:
+            RAG_models.move_to_end(session_id)
+            return RAG
+    return load_rag_model_for_session(session_id)
+
 def load_rag_model_for_session(session_id):
     """
     Loads the RAG model for the given session_id from the index on disk.
@@ -81,36 +162,136 @@ def load_rag_model_for_session(session_id):
 
     if os.path.exists(index_path):
         try:
-            RAG = RAGMultiModalModel.from_index(index_path)
-            RAG_models[session_id] = RAG
+            if is_disk_index(index_path):
+                # Written by index_documents, e.g. for a model evicted from the LRU
+                RAG = open_disk_index(index_path)
+            else:
+                RAG = RAGMultiModalModel.from_index(index_path)
+            cache_rag_model(session_id, RAG)
             logger.info(f"RAG model for session {session_id} loaded from index.")
+            return RAG
         except Exception as e:
             logger.error(f"Error loading RAG model for session {session_id}: {e}")
     else:
         logger.warning(f"No index found for session {session_id}.")
+    return None
 
 def load_existing_indexes():
     """
-    Loads all existing indexes from the .byaldi folder when the application starts.
+    Checks for the .byaldi folder at startup. Indexes themselves are loaded
+    lazily by get_rag_model.
     """
-    global RAG_models
-    if os.path.exists(app.config['INDEX_FOLDER']):
-        for session_id in os.listdir(app.config['INDEX_FOLDER']):
-            if os.path.isdir(os.path.join(app.config['INDEX_FOLDER'], session_id)):
-                load_rag_model_for_session(session_id)
-    else:
+    if not os.path.exists(app.config['INDEX_FOLDER']):
         logger.warning("No .byaldi folder found. No existing indexes to load.")
 
-@app.before_request
-def initialize_app():
+# **Trash Janitor**
+
+def move_to_trash(path):
     """
-    Initializes the application by loading existing indexes.
-    This will run before the first request, but only once.
+    Moves a file or folder into the trash folder; a single rename, regardless of size.
+    """
+    if os.path.exists(path):
+        os.replace(path, os.path.join(app.config['TRASH_FOLDER'], uuid.uuid4().hex))
+
+def empty_trash():
     """
-    if not app.config['INITIALIZATION_DONE']:
-        load_existing_indexes()
-        app.config['INITIALIZATION_DONE'] = True
-        logger.info("Application initialized and indexes loaded.")
+    Removes everything in the trash folder and purges deleted sessions from the store.
+    """
+    for entry in os.listdir(app.config['TRASH_FOLDER']):
+        path = os.path.join(app.config['TRASH_FOLDER'], entry)
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except Exception as e:
+            logger.error(f"Error removing {path} from trash: {e}")
+    session_store.purge_deleted_sessions()
+
+def trash_janitor():
+    while True:
+        try:
+            empty_trash()
+        except Exception as e:
+            logger.error(f"Error emptying trash: {e}")
+        time.sleep(app.config['TRASH_SWEEP_INTERVAL'])
+
+_trash_janitor_thread = None
+_background_lock = threading.Lock()
+
+def start_background_threads():
+    """
+    Starts the session store flusher and the trash janitor, once per process.
+
+    Called on the first request rather than at import: with gunicorn --preload the
+    app is imported in the master, which never serves requests, and a janitor there
+    would sweep the trash concurrently with the worker's.
+    """
+    global _trash_janitor_thread
+    with _background_lock:
+        if _trash_janitor_thread is not None:
+            return
+        session_store.start()
+        _trash_janitor_thread = threading.Thread(target=trash_janitor, name="trash-janitor", daemon=True)
+        _trash_janitor_thread.start()
+
+# **Background Indexing**
+
+# Indexing runs on a single background worker so the request returns immediately
+# and the GPU is never shared by two indexing jobs. The resulting RAG model holds
+# GPU state, so it has to live in this process (not in RQ/Celery workers).
+index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="indexer")
+index_jobs = {}  # job_id -> {'status', 'session_id', 'message', 'indexed_files', 'done_at'}
+index_jobs_lock = threading.Lock()
+# Finished jobs are dropped once their status has been polled, or after this many
+# seconds if the client never comes back for it
+INDEX_JOB_TTL = 3600
+
+def update_index_job(job_id, **fields):
+    with index_jobs_lock:
+        if fields.get('status') in ('finished', 'failed'):
+            fields['done_at'] = time.time()
+        index_jobs[job_id].update(fields)
+
+def prune_index_jobs():
+    # Caller holds index_jobs_lock
+    cutoff = time.time() - INDEX_JOB_TTL
+    for job_id in [job_id for job_id, job in index_jobs.items() if job.get('done_at', cutoff) < cutoff]:
+        del index_jobs[job_id]
+
+def run_index_job(job_id, session_id, session_name, session_folder, index_path, indexer_model, uploaded_files):
+    """
+    Indexes the uploaded files of a session and registers the resulting RAG model.
+    """
+    update_index_job(job_id, status='started')
+    try:
+        RAG = index_documents(session_folder, index_name=session_id, index_path=index_path, indexer_model=indexer_model)
+        if RAG is None:
+            raise ValueError("Indexing failed: RAG model is None")
+        cache_rag_model(session_id, RAG)
+        session_data = session_store.get_session(session_id)
+        # Bump the index version so cached retrievals and answers go stale
+        index_version = (session_data['index_version'] if session_data else 0) + 1
+        session_store.create_session(session_id, session_name)
+        session_store.add_indexed_files(session_id, uploaded_files)
+        session_store.set_index_version(session_id, index_version)
+        invalidate_chat_sessions()
+        logger.info("Documents indexed successfully.")
+        update_index_job(job_id, status='finished', message="Files indexed successfully.",
+                         indexed_files=session_store.get_indexed_files(session_id))
+    except Exception as e:
+        logger.error(f"Error indexing documents: {str(e)}")
+        update_index_job(job_id, status='failed', message=f"Error indexing files: {str(e)}")
+
+# Checked at import time so `gunicorn --preload` does it once in the parent process
+if os.environ.get("GUNICORN_PRELOAD") != "skip":
+    load_existing_indexes()
+    logger.info("Application initialized.")
+
+@app.before_request
+def ensure_background_threads():
+    if _trash_janitor_thread is None:
+        start_background_threads()
 
 @app.before_request
 def make_session_permanent():
@@ -118,6 +299,16 @@ def make_session_permanent():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
 
+# Signs image paths for the unauthenticated /signed_image route
+image_url_signer = URLSafeTimedSerializer(app.secret_key, salt='signed-image')
+
+def signed_image_url(relative_path):
+    """
+    Returns a short-lived public URL for an image under the static folder.
+    """
+    token = image_url_signer.dumps(relative_path)
+    return app.config['PUBLIC_BASE_URL'].rstrip('/') + url_for('signed_image', token=token)
+
 # **Routes**
 
 # **Login and Logout Routes**
@@ -164,22 +355,22 @@ def chat():
         session['session_id'] = str(uuid.uuid4())
 
     session_id = session['session_id']
-    session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
-
-    # Load session data from file
-    if os.path.exists(session_file):
-        with open(session_file, 'r') as f:
-            session_data = json.load(f)
-            chat_history = session_data.get('chat_history', [])
-            session_name = session_data.get('session_name', 'Untitled Session')
-            indexed_files = session_data.get('indexed_files', [])
+
+    # Load session data from the session store
+    session_data = session_store.get_session(session_id)
+    if session_data is not None:
+        chat_history = session_data['chat_history']
+        session_name = session_data['session_name']
+        indexed_files = session_data['indexed_files']
+        index_version = session_data['index_version']
     else:
         chat_history = []
         session_name = 'Untitled Session'
         indexed_files = []
+        index_version = 0
 
-    if request.method == 'POST' and 'send_query' in request.form:
-        query = request.form['query']
+    if request.method == 'POST':
+        query = request.form.get('query', '')
         # Retrieve answer length from the form data
         answer_length = request.form.get('answer_length', 'short')
         if 'upload' in request.form:
@@ -188,38 +379,57 @@ def chat():
             session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
             os.makedirs(session_folder, exist_ok=True)
             uploaded_files = []
+            duplicate_files = []
+            # Content hashes of files already saved in this session, to skip re-uploads
+            file_hashes = session_store.get_file_hashes(session_id)
             for file in files:
                 if file and file.filename:
                     filename = secure_filename(file.filename)
+                    file_hash = hash_upload(file)
+                    if file_hash in file_hashes:
+                        existing = file_hashes[file_hash]
+                        # Same content was saved before; index it only if that never succeeded
+                        if existing not in indexed_files and existing not in uploaded_files:
+                            uploaded_files.append(existing)
+                        duplicate_files.append(filename)
+                        logger.info(f"Skipping duplicate upload {filename} (same content as {existing}).")
+                        continue
                     file_path = os.path.join(session_folder, filename)
                     file.save(file_path)
+                    # The file may overwrite one with other content; its old hash no longer applies
+                    for stale_hash in [h for h, name in file_hashes.items() if name == filename]:
+                        del file_hashes[stale_hash]
+                    file_hashes[file_hash] = filename
+                    session_store.create_session(session_id, session_name)
+                    session_store.add_file_hash(session_id, file_hash, filename)
                     uploaded_files.append(filename)
                     logger.info(f"File saved: {file_path}")
             
-            if uploaded_files:
+            if not uploaded_files and duplicate_files:
+                return jsonify({
+                    "success": True,
+                    "message": "These files are already indexed.",
+                    "indexed_files": indexed_files
+                })
+            elif uploaded_files:
                 try:
                     index_name = session_id
                     index_path = os.path.join(app.config['INDEX_FOLDER'], index_name)
                     indexer_model = session.get('indexer_model', 'vidore/colpali')
-                    RAG = index_documents(session_folder, index_name=index_name, index_path=index_path, indexer_model=indexer_model)
-                    if RAG is None:
-                        raise ValueError("Indexing failed: RAG model is None")
-                    RAG_models[session_id] = RAG
                     session['index_name'] = index_name
                     session['session_folder'] = session_folder
-                    indexed_files.extend(uploaded_files)
-                    session_data = {
-                        'session_name': session_name,
-                        'chat_history': chat_history,
-                        'indexed_files': indexed_files
-                    }
-                    with open(session_file, 'w') as f:
-                        json.dump(session_data, f)
-                    logger.info("Documents indexed successfully.")
+                    job_id = uuid.uuid4().hex
+                    with index_jobs_lock:
+                        prune_index_jobs()
+                        index_jobs[job_id] = {'status': 'queued', 'session_id': session_id,
+                                              'message': '', 'indexed_files': indexed_files}
+                    index_executor.submit(run_index_job, job_id, session_id, session_name, session_folder,
+                                          index_path, indexer_model, uploaded_files)
+                    logger.info(f"Indexing job {job_id} queued for session {session_id}.")
                     return jsonify({
-                        "success": True, 
-                        "message": "Files indexed successfully.",
-                        "indexed_files": indexed_files
+                        "success": True,
+                        "message": "Indexing started.",
+                        "job_id": job_id
                     })
                 except Exception as e:
                     logger.error(f"Error indexing documents: {str(e)}")
@@ -234,35 +444,65 @@ def chat():
             
             try:
                 generation_model = session.get('generation_model', 'qwen')
+                quantization = session.get('quantization', 'none')
                 resized_height = session.get('resized_height', 280)
                 resized_width = session.get('resized_width', 280)
                 
-                # Retrieve relevant documents
-                rag_model = RAG_models.get(session_id)
-                if rag_model is None:
-                    logger.error(f"RAG model not found for session {session_id}")
-                    return jsonify({"success": False, "message": "RAG model not found for this session."})
-                
-                retrieved_images = retrieve_documents(rag_model, query, session_id)
+                # Repeated queries are served from the retrieval and answer caches;
+                # the RAG model is only loaded when retrieval has to run
+                qkey = rag_cache.query_key(query)
+                retrieved_images = rag_cache.get_retrieval(session_id, index_version, qkey)
+                if retrieved_images is None:
+                    # Retrieve relevant documents
+                    rag_model = get_rag_model(session_id)
+                    if rag_model is None:
+                        logger.error(f"RAG model not found for session {session_id}")
+                        return jsonify({"success": False, "message": "RAG model not found for this session."})
+                    retrieved_images = retrieve_documents(rag_model, query, session_id)
+                    if retrieved_images:
+                        rag_cache.set_retrieval(session_id, index_version, qkey, retrieved_images)
+                else:
+                    logger.info("Retrieval cache hit.")
                 logger.info(f"Retrieved images: {retrieved_images}")
-                
-                # Generate response with full image paths
-                full_image_paths = [os.path.join(app.static_folder, img) for img in retrieved_images]
-                response = generate_response(
-                    full_image_paths, query, session_id, resized_height,
-                    resized_width, generation_model, answer_length=answer_length  # Pass the answer length parameter
-                )
-                
-                # Parse markdown in the response
-                parsed_response = Markup(markdown.markdown(response))
 
-                # **Inline Section References**
-                # Detect and inline section references in the response
-                sections_referenced = find_section_references(response)
-                if sections_referenced:
-                    sections_dict = load_sections_for_session(session_id)
-                    section_texts = get_section_texts(sections_referenced, sections_dict)
-                    parsed_response = embed_section_text(parsed_response, section_texts)
+                answer_cache_args = (session_id, index_version, qkey, retrieved_images,
+                                     f"{generation_model}:{quantization}", answer_length,
+                                     resized_height, resized_width)
+                cached_response = rag_cache.get_answer(*answer_cache_args)
+                if cached_response is not None:
+                    logger.info("Answer cache hit.")
+                    parsed_response = Markup(cached_response)
+                else:
+                    # Generate response with full image paths
+                    full_image_paths = [os.path.join(app.static_folder, img) for img in retrieved_images]
+                    image_urls = None
+                    if generation_model == 'gpt4' and app.config['PUBLIC_BASE_URL']:
+                        image_urls = [signed_image_url(img) for img in retrieved_images]
+                    try:
+                        response = generate_response(
+                            full_image_paths, query, session_id, resized_height,
+                            resized_width, generation_model, answer_length=answer_length,  # Pass the answer length parameter
+                            quantization=quantization, image_urls=image_urls
+                        )
+                        generated = True
+                    except GenerationError as e:
+                        # Shown in the chat like before, but never cached as the answer
+                        response = str(e)
+                        generated = False
+
+                    # Parse markdown in the response
+                    parsed_response = Markup(markdown.markdown(response))
+
+                    # **Inline Section References**
+                    # Detect and inline section references in the response
+                    sections_referenced = find_section_references(response)
+                    if sections_referenced:
+                        sections_dict = load_sections_for_session(session_id)
+                        section_texts = get_section_texts(sections_referenced, sections_dict)
+                        parsed_response = embed_section_text(parsed_response, section_texts)
+
+                    if generated and retrieved_images:
+                        rag_cache.set_answer(*answer_cache_args, parsed_response)
 
                 # Update chat history
                 chat_history.append({"role": "user", "content": query})
@@ -272,17 +512,16 @@ def chat():
                     "images": retrieved_images  # Keep relative paths for frontend
                 })
                 
+                # Only the two new messages are written, not the whole history
+                session_store.create_session(session_id, session_name)
+                session_store.append_message(session_id, "user", query)
+                session_store.append_message(session_id, "assistant", parsed_response, retrieved_images)
+
                 # Update session name if it's the first message
                 if len(chat_history) == 2:  # First user message and AI response
                     session_name = query[:50]  # Truncate to 50 characters
-                
-                session_data = {
-                    'session_name': session_name,
-                    'chat_history': chat_history,
-                    'indexed_files': indexed_files
-                }
-                with open(session_file, 'w') as f:
-                    json.dump(session_data, f)
+                    session_store.rename_session(session_id, session_name)
+                    invalidate_chat_sessions()
                 
                 # Render the new messages
                 new_messages_html = render_template('chat_messages.html', messages=[
@@ -299,15 +538,7 @@ def chat():
                 return jsonify({"success": False, "message": f"An error occurred while generating the response: {str(e)}"})
 
     # For GET requests, render the chat page
-    session_files = os.listdir(app.config['SESSION_FOLDER'])
-    chat_sessions = []
-    for file in session_files:
-        if file.endswith('.json'):
-            s_id = file[:-5]
-            with open(os.path.join(app.config['SESSION_FOLDER'], file), 'r') as f:
-                data = json.load(f)
-                name = data.get('session_name', 'Untitled Session')
-                chat_sessions.append({'id': s_id, 'name': name})
+    chat_sessions = get_chat_sessions()
 
     model_choice = session.get('model', 'qwen')
     resized_height = session.get('resized_height', 280)
@@ -318,14 +549,42 @@ def chat():
                            resized_height=resized_height, resized_width=resized_width,
                            session_name=session_name, indexed_files=indexed_files)
 
+@app.route('/retrieved/<path:filename>')
+@login_required
+def retrieved_image(filename):
+    """
+    Serves a retrieved page image (a path under static/images).
+    """
+    if not filename.startswith('images/'):
+        abort(404)
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        # Same traversal checks as send_from_directory
+        path = safe_join(app.static_folder, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + filename
+        return response
+    # send_from_directory uses the server's wsgi.file_wrapper (sendfile under gunicorn)
+    return send_from_directory(app.static_folder, filename)
+
+@app.route('/signed_image/<token>')
+def signed_image(token):
+    # Not behind login: the token itself authorizes access, for a limited time
+    try:
+        relative_path = image_url_signer.loads(token, max_age=app.config['SIGNED_IMAGE_MAX_AGE'])
+    except BadSignature:
+        abort(404)
+    return send_from_directory(app.static_folder, relative_path)
+
 # **Additional Routes with @login_required Decorator**
 
 @app.route('/switch_session/<session_id>')
 @login_required
 def switch_session(session_id):
     session['session_id'] = session_id
-    if session_id not in RAG_models:
-        load_rag_model_for_session(session_id)
+    get_rag_model(session_id)
     flash(f"Switched to session.", "info")
     return redirect(url_for('chat'))
 
@@ -334,17 +593,9 @@ def switch_session(session_id):
 def rename_session():
     session_id = request.form.get('session_id')
     new_session_name = request.form.get('new_session_name', 'Untitled Session')
-    session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
-
-    if os.path.exists(session_file):
-        with open(session_file, 'r') as f:
-            session_data = json.load(f)
-        
-        session_data['session_name'] = new_session_name
-
-        with open(session_file, 'w') as f:
-            json.dump(session_data, f)
 
+    if session_store.rename_session(session_id, new_session_name):
+        invalidate_chat_sessions()
         return jsonify({"success": True, "message": "Session name updated."})
     else:
         return jsonify({"success": False, "message": "Session not found."})
@@ -353,21 +604,16 @@ def rename_session():
 @login_required
 def delete_session(session_id):
     try:
-        session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
-        if os.path.exists(session_file):
-            os.remove(session_file)
+        session_store.delete_session(session_id)
+        invalidate_chat_sessions()
         
-        session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
-        if os.path.exists(session_folder):
-            import shutil
-            shutil.rmtree(session_folder)
+        # Renamed into the trash and removed in the background, so this returns right away
+        move_to_trash(os.path.join(app.config['UPLOAD_FOLDER'], session_id))
+        move_to_trash(os.path.join(app.config['STATIC_FOLDER'], 'images', session_id))
         
-        session_images_folder = os.path.join('static', 'images', session_id)
-        if os.path.exists(session_images_folder):
-            import shutil
-            shutil.rmtree(session_images_folder)
-        
-        RAG_models.pop(session_id, None)
+        with RAG_models_lock:
+            RAG_models.pop(session_id, None)
+        rag_cache.invalidate_session(session_id)
         
         if session.get('session_id') == session_id:
             session['session_id'] = str(uuid.uuid4())
@@ -384,24 +630,28 @@ def settings():
     if request.method == 'POST':
         indexer_model = request.form.get('indexer_model', 'vidore/colpali')
         generation_model = request.form.get('generation_model', 'qwen')
+        quantization = request.form.get('quantization', 'none')
         resized_height = session.get('resized_height', 280)
         resized_width = session.get('resized_width', 280)
         session['indexer_model'] = indexer_model
         session['generation_model'] = generation_model
+        session['quantization'] = quantization
         session['resized_height'] = resized_height
         session['resized_width'] = resized_width
         session.modified = True
-        logger.info(f"Settings updated: indexer_model={indexer_model}, generation_model={generation_model}, resized_height={resized_height}, resized_width={resized_width}")
+        logger.info(f"Settings updated: indexer_model={indexer_model}, generation_model={generation_model}, quantization={quantization}, resized_height={resized_height}, resized_width={resized_width}")
         flash("Settings updated.", "success")
         return redirect(url_for('chat'))
     else:
         indexer_model = session.get('indexer_model', 'vidore/colpali')
         generation_model = session.get('generation_model', 'qwen')
+        quantization = session.get('quantization', 'none')
         resized_height = session.get('resized_height', 280)
         resized_width = session.get('resized_width', 280)
         return render_template('settings.html', 
                                indexer_model=indexer_model,
                                generation_model=generation_model,
+                               quantization=quantization,
                                resized_height=resized_height, 
                                resized_width=resized_width)
 
@@ -410,40 +660,58 @@ def settings():
 def new_session():
     session_id = str(uuid.uuid4())
     session['session_id'] = session_id
-    session_files = os.listdir(app.config['SESSION_FOLDER'])
-    session_number = len([f for f in session_files if f.endswith('.json')]) + 1
+    session_number = session_store.count_sessions() + 1
     session_name = f"Session {session_number}"
-    session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
-    session_data = {
-        'session_name': session_name,
-        'chat_history': [],
-        'indexed_files': []
-    }
-    with open(session_file, 'w') as f:
-        json.dump(session_data, f)
+    session_store.create_session(session_id, session_name)
+    invalidate_chat_sessions()
     flash("New chat session started.", "success")
     return redirect(url_for('chat'))
 
+@app.route('/index_status/<job_id>')
+@login_required
+def index_status(job_id):
+    with index_jobs_lock:
+        job = dict(index_jobs[job_id]) if job_id in index_jobs else None
+        if job is not None and 'done_at' in job:
+            # The client stops polling once it sees the final status
+            del index_jobs[job_id]
+    if job is None:
+        return jsonify({"success": False, "message": "Indexing job not found."})
+    return jsonify({
+        "success": True,
+        "status": job['status'],
+        "message": job['message'],
+        "indexed_files": job['indexed_files']
+    })
+
 @app.route('/get_indexed_files/<session_id>')
 @login_required
 def get_indexed_files(session_id):
-    session_file = os.path.join(app.config['SESSION_FOLDER'], f"{session_id}.json")
-    if os.path.exists(session_file):
-        with open(session_file, 'r') as f:
-            session_data = json.load(f)
-            indexed_files = session_data.get('indexed_files', [])
+    if session_store.session_exists(session_id):
+        indexed_files = session_store.get_indexed_files(session_id)
         return jsonify({"success": True, "indexed_files": indexed_files})
     else:
         return jsonify({"success": False, "message": "Session not found."})
 
+# **Helper Functions for Uploads**
+
+def hash_upload(file):
+    """
+    Returns the BLAKE2b hex digest of an uploaded file and rewinds its stream.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: file.stream.read(1 << 20), b''):
+        hasher.update(chunk)
+    file.stream.seek(0)
+    return hasher.hexdigest()
+
 # **Helper Functions for Inline Section References**
 
+# Section references in generated answers, e.g. "Section 2.1"
+_SECTION_REF_RE = re.compile(r'Section\s+(\d+(?:\.\d+)*)')
+
 def find_section_references(answer_text):
-    import re
-    pattern = r'Section\s+(\d+(\.\d+)*)'
-    matches = re.findall(pattern, answer_text)
-    sections = [match[0] for match in matches]
-    return sections
+    return _SECTION_REF_RE.findall(answer_text)
 
 def load_sections_for_session(session_id):
     """
@@ -451,34 +719,43 @@ def load_sections_for_session(session_id):
     """
     session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
     sections = {}
+    if not os.path.isdir(session_folder):
+        return sections
     for filename in os.listdir(session_folder):
         file_path = os.path.join(session_folder, filename)
         if filename.endswith('.pdf') or filename.endswith('.txt'):
-            file_sections = parse_document(file_path)
+            file_sections = parse_document_cached(file_path)
             sections.update(file_sections)
     return sections
 
+def parse_document_cached(file_path):
+    """
+    Returns the parsed sections of a document, parsing it only if it changed
+    since it was last parsed.
+    """
+    st = os.stat(file_path)
+    key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+    file_sections = section_cache.get(key)
+    if file_sections is None:
+        file_sections = parse_document(file_path)
+        section_cache.set(key, file_sections)
+    else:
+        logger.debug(f"Sections for {file_path} loaded from cache.")
+    return file_sections
+
 def parse_document(file_path):
     """
     Parse the document and extract sections.
     """
-    import re
     sections = {}
     try:
         if file_path.endswith('.pdf'):
-            from pdfminer.high_level import extract_text
+            from models.pdf_render import extract_text
             text = extract_text(file_path)
         else:
             with open(file_path, 'r') as f:
                 text = f.read()
-        current_section = None
-        for line in text.split('\n'):
-            section_match = re.match(r'(Section\s+)?(\d+(\.\d+)*)', line.strip())
-            if section_match:
-                current_section = section_match.group(2)
-                sections[current_section] = ''
-            elif current_section:
-                sections[current_section] += line + '\n'
+        sections = parse_sections(text)
     except Exception as e:
         logger.error(f"Error parsing document {file_path}: {e}")
     return sections
@@ -492,14 +769,28 @@ def get_section_texts(sections_referenced, sections_dict):
     return section_texts
 
 def embed_section_text(answer_text, section_texts):
-    for sec, text in section_texts.items():
-        answer_text = answer_text.replace(
-            f'Section {sec}',
-            f'Section {sec}: "{text.strip()}"'
-        )
-    return answer_text
+    """
+    Inlines the text of each referenced section after its "Section N" mention,
+    in a single pass over the answer.
+    """
+    if not section_texts:
+        return answer_text
+    # Longest numbers first so "1.10" is not matched as "1.1"
+    numbers = sorted(section_texts, key=len, reverse=True)
+    pattern = re.compile(r'Section (' + '|'.join(re.escape(sec) for sec in numbers) + r')\b')
+    is_markup = isinstance(answer_text, Markup)
+
+    def inline_section(match):
+        sec = match.group(1)
+        text = section_texts[sec].strip()
+        if is_markup:
+            text = escape(text)
+        return f'Section {sec}: "{text}"'
+
+    embedded = pattern.sub(inline_section, str(answer_text))
+    return Markup(embedded) if is_markup else embedded
 
 # **Run the App**
 
 if __name__ == '__main__':
-    app.run(port=5050, debug=True)
+    app.run(port=5050)
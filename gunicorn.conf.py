@@ -0,0 +1,13 @@
+# gunicorn.conf.py
+#
+# Run with: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# A single preloaded worker keeps one copy of the models and indexes in memory;
+# threads serve concurrent requests while CUDA calls release the GIL.
+
+bind = "0.0.0.0:5050"
+preload_app = True
+workers = 1
+threads = 8
+worker_class = "gthread"
+timeout = 300
@@ -1,31 +1,404 @@
 # models/indexer.py
 
 import os
+import io
+import json
+import inspect
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from diskcache import Cache
+from diskcache.core import DBNAME
 from byaldi import RAGMultiModalModel
 from models.converters import convert_docs_to_pdfs
+from models.pdf_render import render_pdf_in_subprocess, cache_text
 from logger import get_logger
+import numpy as np
 import pickle
 
 
 logger = get_logger(__name__)
 
+# Number of PDFs rendered ahead of the GPU while it embeds the current one
+RENDER_AHEAD = 2
+
+# First byte of a pickle (protocol 2+); encoded images (WebP, PNG, JPEG) never start with it
+PICKLE_PROTOCOL_MARKER = b'\x80'
+
 class DiskCacheIndexer:
+    """
+    Stores page images and embeddings in a diskcache.
+
+    Embeddings are stored as a raw float16 buffer under `<key>_embedding` with
+    their shape under `<key>_shape`, so loading is a single np.frombuffer instead
+    of unpickling. Images are stored as losslessly encoded WebP bytes.
+
+    For retrieval, every embedding is also written L2-normalized as a float32
+    row of a single matrix file (`embeddings.f32`), with the page key of each row
+    appended to `embeddings.keys`. Queries memory-map the file (`embedding_matrix`,
+    with the page keys in `keys`) instead of reading every embedding from the cache.
+    An int8 copy of each row (`embeddings.i8`) allows a quantized first-pass scan.
+    """
+    # Explicitly little-endian so the files read back the same on any machine
+    EMBEDDING_DTYPE = np.dtype('<f2')
+    MATRIX_DTYPE = np.dtype('<f4')
+    MATRIX_FILE = 'embeddings.f32'
+    MATRIX_INT8_FILE = 'embeddings.i8'
+    MATRIX_KEYS_FILE = 'embeddings.keys'
+    MATRIX_DIM_KEY = '_matrix_dim'
+    INDEXER_MODEL_KEY = '_indexer_model'
+
     def __init__(self, cache_dir='./cache'):
-        self.cache = Cache(cache_dir)
+        self.cache = Cache(cache_dir, sqlite_synchronous='NORMAL', sqlite_journal_mode='WAL')
+        self.matrix_path = os.path.join(self.cache.directory, self.MATRIX_FILE)
+        self.matrix_keys_path = os.path.join(self.cache.directory, self.MATRIX_KEYS_FILE)
+        self.matrix_int8_path = os.path.join(self.cache.directory, self.MATRIX_INT8_FILE)
+        self._matrix_lock = threading.Lock()
+        self._rows = None  # page key -> row in the matrix file
+        self._keys = None
+        self._matrix = None
+        self._matrix_int8 = None
+        if not os.path.exists(self.matrix_keys_path) and not self._has_stored_embeddings():
+            # New cache: start with an empty matrix so the first write does not take
+            # the conversion path for caches written before the matrix file existed
+            open(self.matrix_keys_path, 'a').close()
+
+    def _has_stored_embeddings(self):
+        return any(isinstance(cache_key, str) and cache_key.endswith('_embedding')
+                   for cache_key in self.cache.iterkeys())
 
     def store_image(self, key, image):
-        self.cache.set(f"{key}_image", pickle.dumps(image))
+        image_data = encode_image_bytes(image)
+        with self.cache.transact(retry=True):
+            self.cache.set(f"{key}_image", image_data)
+            self.cache.set(f"{key}_digest", image_digest(image_data))
 
     def store_embedding(self, key, embedding):
-        self.cache.set(f"{key}_embedding", pickle.dumps(embedding))
+        shape, data = self._embedding_bytes(embedding)
+        row = normalize_embedding(embedding)
+        with self.cache.transact(retry=True):
+            self.cache.set(f"{key}_shape", shape)
+            self.cache.set(f"{key}_embedding", data)
+            self._write_matrix_row(key, row)
+
+    def store_page(self, key, image, embedding):
+        """
+        Stores a page's image and embedding in a single transaction.
+        """
+        self.store_pages([(key, image, embedding)])
+
+    def store_pages(self, pages):
+        """
+        Stores (key, image, embedding) pages in a single transaction. Everything is
+        encoded before the transaction starts, so the SQLite write lock is only held
+        for the writes themselves.
+        """
+        encoded = []
+        for key, image, embedding in pages:
+            image_data = encode_image_bytes(image)
+            shape, data = self._embedding_bytes(embedding)
+            encoded.append((key, image_data, shape, data, normalize_embedding(embedding)))
+        with self.cache.transact(retry=True):
+            for key, image_data, shape, data, row in encoded:
+                self.cache.set(f"{key}_image", image_data)
+                self.cache.set(f"{key}_digest", image_digest(image_data))
+                self.cache.set(f"{key}_shape", shape)
+                self.cache.set(f"{key}_embedding", data)
+                self._write_matrix_row(key, row)
+
+    def _embedding_bytes(self, embedding):
+        array = np.ascontiguousarray(embedding_to_numpy(embedding).astype(self.EMBEDDING_DTYPE))
+        return tuple(array.shape), array.tobytes()
 
     def get_image(self, key):
-        return pickle.loads(self.cache.get(f"{key}_image"))
+        data = self.cache.get(f"{key}_image")
+        if data is None:
+            return None
+        if not isinstance(data, bytes):
+            return data
+        if data.startswith(PICKLE_PROTOCOL_MARKER):
+            # Entries written before the switch to WebP were pickled
+            return pickle.loads(data)
+        return data
+
+    def get_pages(self, keys):
+        """
+        Returns (image, digest) for several pages, read in a single transaction.
+        The digest identifies the image content; it is None for entries stored
+        before digests were recorded.
+        """
+        with self.cache.transact(retry=True):
+            return [(self.get_image(key), self.cache.get(f"{key}_digest")) for key in keys]
 
     def get_embedding(self, key):
-        return pickle.loads(self.cache.get(f"{key}_embedding"))
+        data = self.cache.get(f"{key}_embedding")
+        if data is None:
+            return None
+        shape = self.cache.get(f"{key}_shape")
+        if shape is None:
+            # Entries written before the switch to raw buffers were pickled
+            return pickle.loads(data)
+        return np.frombuffer(data, dtype=self.EMBEDDING_DTYPE).reshape(shape)
+
+    # **Embedding matrix**
+
+    def invalidate_embedding_matrix(self):
+        with self._matrix_lock:
+            self._keys = None
+            self._matrix = None
+            self._matrix_int8 = None
+
+    def embedding_index(self):
+        """
+        Returns (keys, matrix) where row i of the (N, D) float32 matrix is the
+        L2-normalized embedding of page keys[i]. The matrix is a read-only memmap
+        of the matrix file, reopened after new embeddings are stored.
+        """
+        with self._matrix_lock:
+            if self._matrix is None:
+                rows = self._load_matrix_rows()
+                keys = [None] * len(rows)
+                for key, row in rows.items():
+                    keys[row] = key
+                dim = self.cache.get(self.MATRIX_DIM_KEY, 0)
+                if rows:
+                    matrix = np.memmap(self.matrix_path, dtype=self.MATRIX_DTYPE, mode='r', shape=(len(rows), dim))
+                else:
+                    matrix = np.empty((0, dim), dtype=self.MATRIX_DTYPE)
+                self._keys, self._matrix, self._matrix_int8 = keys, matrix, None
+            return self._keys, self._matrix
+
+    def quantized_embedding_index(self):
+        """
+        Returns (keys, matrix, matrix_int8) where matrix_int8 holds the rows of
+        matrix quantized with quantize_embedding, as a read-only memmap.
+        """
+        while True:
+            keys, matrix = self.embedding_index()
+            with self._matrix_lock:
+                if self._matrix is not matrix:
+                    continue  # An embedding was stored in between; take the new snapshot
+                if self._matrix_int8 is None:
+                    expected_size = matrix.shape[0] * matrix.shape[1]
+                    if matrix.shape[0] and (not os.path.exists(self.matrix_int8_path)
+                                            or os.path.getsize(self.matrix_int8_path) < expected_size):
+                        # Matrix files written before the int8 copy existed
+                        quantize_embedding(np.asarray(matrix)).tofile(self.matrix_int8_path)
+                        logger.info(f"Built int8 embedding matrix file with {matrix.shape[0]} rows.")
+                    if matrix.shape[0]:
+                        self._matrix_int8 = np.memmap(self.matrix_int8_path, dtype=np.int8, mode='r',
+                                                      shape=matrix.shape)
+                    else:
+                        self._matrix_int8 = np.empty(matrix.shape, dtype=np.int8)
+                return keys, matrix, self._matrix_int8
+
+    @property
+    def keys(self):
+        return self.embedding_index()[0]
+
+    @property
+    def embedding_matrix(self):
+        return self.embedding_index()[1]
 
+    def _write_matrix_row(self, key, row):
+        # row is the normalized embedding, see normalize_embedding
+        with self._matrix_lock:
+            self._put_matrix_row(key, row)
+            self._keys = None
+            self._matrix = None
+            self._matrix_int8 = None
+
+    def _put_matrix_row(self, key, row):
+        # Caller holds _matrix_lock. The row is written before its key is appended,
+        # so an interrupted write leaves at most an unreferenced row at the end.
+        rows = self._load_matrix_rows()
+        dim = self.cache.get(self.MATRIX_DIM_KEY)
+        if dim is None:
+            self.cache.set(self.MATRIX_DIM_KEY, row.shape[0])
+        elif dim != row.shape[0]:
+            raise ValueError(f"Embedding for {key} has {row.shape[0]} dimensions, expected {dim}")
+
+        index = rows.get(key)
+        mode = 'r+b' if os.path.exists(self.matrix_path) else 'wb'
+        position = len(rows) if index is None else index
+        row = row.astype(self.MATRIX_DTYPE, copy=False)
+        with open(self.matrix_path, mode) as f:
+            f.seek(position * row.nbytes)
+            f.write(row.tobytes())
+        if os.path.exists(self.matrix_int8_path):
+            # Otherwise the int8 file is built from the matrix file when first needed
+            with open(self.matrix_int8_path, 'r+b') as f:
+                f.seek(position * row.shape[0])
+                f.write(quantize_embedding(row).tobytes())
+        if index is None:
+            with open(self.matrix_keys_path, 'a') as f:
+                f.write(json.dumps(key) + '\n')
+            rows[key] = len(rows)
+
+    def _load_matrix_rows(self):
+        # Caller holds _matrix_lock
+        if self._rows is not None:
+            return self._rows
+        self._rows = {}
+        if os.path.exists(self.matrix_keys_path):
+            with open(self.matrix_keys_path) as f:
+                for line in f:
+                    try:
+                        self._rows[json.loads(line)] = len(self._rows)
+                    except ValueError:
+                        break  # Truncated last line of an interrupted write
+        else:
+            # Caches written before the matrix file existed: build it once from the stored
+            # embeddings, read in a single transaction instead of one per cache lookup
+            with self.cache.transact(retry=True):
+                for cache_key in list(self.cache.iterkeys()):
+                    if isinstance(cache_key, str) and cache_key.endswith('_embedding'):
+                        key = cache_key[:-len('_embedding')]
+                        embedding = self.get_embedding(key)
+                        if embedding is not None:
+                            self._put_matrix_row(key, normalize_embedding(embedding))
+            if self._rows:
+                logger.info(f"Built embedding matrix file with {len(self._rows)} rows.")
+        return self._rows
+
+
+class DiskIndexRAG:
+    """
+    A disk-backed index reopened from its cache directory.
+
+    Has the retrieval attributes of the RAG model returned by index_documents,
+    but encodes queries with a RAGMultiModalModel shared by every index built
+    with the same indexer model.
+    """
+    use_disk_storage = True
+
+    def __init__(self, encoder, disk_cache):
+        self.encoder = encoder
+        self.disk_cache = disk_cache
+
+    def encode_query(self, query):
+        return self.encoder.encode_query(query)
+
+# indexer model -> RAGMultiModalModel used to encode queries for reopened indexes
+_query_encoders = {}
+_query_encoders_lock = threading.Lock()
+
+def is_disk_index(index_path):
+    """
+    Returns True if index_path holds a DiskCacheIndexer cache written by
+    index_documents rather than a byaldi index.
+    """
+    return os.path.isfile(os.path.join(index_path, DBNAME))
+
+def open_disk_index(index_path, indexer_model='vidore/colpali'):
+    """
+    Reopens an index written by index_documents without re-indexing it.
+
+    Args:
+        index_path (str): The cache directory passed to index_documents.
+        indexer_model (str): The indexer model to use if the cache does not record one.
+
+    Returns:
+        DiskIndexRAG: The reopened index.
+    """
+    disk_cache = DiskCacheIndexer(cache_dir=index_path)
+    indexer_model = disk_cache.cache.get(DiskCacheIndexer.INDEXER_MODEL_KEY, indexer_model)
+    with _query_encoders_lock:
+        encoder = _query_encoders.get(indexer_model)
+        if encoder is None:
+            encoder = RAGMultiModalModel.from_pretrained(indexer_model)
+            _query_encoders[indexer_model] = encoder
+            logger.info(f"Query encoder initialized with {indexer_model}.")
+    return DiskIndexRAG(encoder, disk_cache)
+
+def embedding_to_numpy(embedding):
+    """
+    Converts a torch tensor or array-like embedding to a NumPy array.
+    """
+    if hasattr(embedding, 'detach'):
+        embedding = embedding.detach().float().cpu().numpy()
+    return np.asarray(embedding)
+
+def normalize_embedding(embedding):
+    """
+    Returns the embedding as a flat, unit-norm float32 vector.
+
+    Page embeddings go through this once when stored and the query once per
+    search, so cosine similarity at query time is a plain dot product.
+    """
+    vector = embedding_to_numpy(embedding).astype(np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+def quantize_embedding(vectors):
+    """
+    Symmetrically quantizes vectors (the last axis) to int8 with a per-vector scale.
+
+    The scale is not kept: cosine similarity is invariant to it, so the int8 vectors
+    can be compared directly.
+    """
+    scale = np.max(np.abs(vectors), axis=-1, keepdims=True)
+    scale[scale == 0] = 1.0
+    return np.round(vectors / scale * 127).astype(np.int8)
+
+def image_digest(image_data):
+    """
+    Returns a short hash of the encoded image, computed once when the page is stored.
+    """
+    return hashlib.blake2b(image_data, digest_size=8).hexdigest()
+
+def encode_image_bytes(image):
+    """
+    Encodes a PIL image as lossless WebP bytes. Raw bytes are stored unchanged.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    buffer = io.BytesIO()
+    image.save(buffer, format='WEBP', lossless=True)
+    return buffer.getvalue()
+
+
+def _supports_prerendered_pages(RAG):
+    """
+    Returns True if RAG.index_document accepts already rendered page images.
+    """
+    try:
+        return 'images' in inspect.signature(RAG.index_document).parameters
+    except (TypeError, ValueError):
+        return False
+
+def _rasterized_pdfs(folder_path, pdf_files):
+    """
+    Yields (filename, page_images) in order while rendering the next PDFs in
+    separate processes, so page rendering overlaps with embedding on the GPU.
+    Besides the PDF being embedded, at most RENDER_AHEAD PDFs are rendering or
+    rendered and waiting; pages come back PNG-encoded.
+
+    Each PDF is opened once: the text extracted alongside the pages is cached
+    for section parsing.
+    """
+    # Threads only wait on the render processes (PyMuPDF is not thread-safe)
+    with ThreadPoolExecutor(max_workers=RENDER_AHEAD) as executor:
+        files = iter(pdf_files)
+        pending = deque()
+
+        def submit_next():
+            file = next(files, None)
+            if file is not None:
+                pending.append((file, executor.submit(render_pdf_in_subprocess, os.path.join(folder_path, file))))
+
+        for _ in range(RENDER_AHEAD):
+            submit_next()
+        while pending:
+            file, future = pending.popleft()
+            text, images = future.result()
+            cache_text(os.path.join(folder_path, file), text)
+            # Start the next render only once this PDF is taken off the queue
+            submit_next()
+            yield file, images
 
 def index_documents(folder_path, index_name='document_index', index_path=None, indexer_model='vidore/colpali'):
     """
@@ -46,11 +419,8 @@ def index_documents(folder_path, index_name='document_index', index_path=None, i
         convert_docs_to_pdfs(folder_path)
         logger.info("Conversion of non-PDF documents to PDFs completed.")
 
-       
         # Initialize RAG model
         RAG = RAGMultiModalModel.from_pretrained(indexer_model)
-        RAG.use_disk_storage = True
-        RAG.disk_cache = disk_cache
 
          # Switch model to half precision to save GPU memory; not needed on all devices
         # RAG.half()
@@ -61,17 +431,26 @@ def index_documents(folder_path, index_name='document_index', index_path=None, i
 
         # Initialize disk cache
         disk_cache = DiskCacheIndexer(cache_dir=index_path)
+        # Lets open_disk_index encode queries with the same model
+        disk_cache.cache.set(DiskCacheIndexer.INDEXER_MODEL_KEY, indexer_model)
 
         # Index the documents in the folder
-        for file in os.listdir(folder_path):
-            if file.endswith('.pdf'):
-                pdf_path = os.path.join(folder_path, file)
+        pdf_files = sorted(file for file in os.listdir(folder_path) if file.endswith('.pdf'))
+        if _supports_prerendered_pages(RAG):
+            documents = _rasterized_pdfs(folder_path, pdf_files)
+        else:
+            documents = ((file, None) for file in pdf_files)
+
+        for file, pages in documents:
+            pdf_path = os.path.join(folder_path, file)
+            if pages is None:
                 images, embeddings = RAG.index_document(pdf_path)
-                
-                for i, (image, embedding) in enumerate(zip(images, embeddings)):
-                    key = f"{file}_{i}"
-                    disk_cache.store_image(key, image)
-                    disk_cache.store_embedding(key, embedding)
+            else:
+                images, embeddings = RAG.index_document(pdf_path, images=pages)
+
+            # One group commit per document instead of one per cache write
+            disk_cache.store_pages([(f"{file}_{i}", image, embedding)
+                                    for i, (image, embedding) in enumerate(zip(images, embeddings))])
 
         logger.info(f"Indexing completed. Index saved at '{index_path}'.")
 
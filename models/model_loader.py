@@ -1,8 +1,9 @@
 # models/model_loader.py
 
 import os
+import gc
 import torch
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
+from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
 from vllm.sampling_params import SamplingParams
 from vllm import LLM
 
@@ -15,9 +16,20 @@ from logger import get_logger
 
 logger = get_logger(__name__)
 
+# Allow TF32 tensor-core matmuls for any float32 work on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+
 # Cache for loaded models
 _model_cache = {}
 
+# FlashAttention-2 needs an Ampere or newer GPU; set USE_FLASH_ATTN=0 to fall back to SDPA
+USE_FLASH_ATTN = os.getenv("USE_FLASH_ATTN", "1").lower() in ("1", "true", "yes")
+# Opt-in: compile the forward pass with mode="reduce-overhead". CUDA graphs need fixed
+# shapes, so this only pays off together with USE_DECODE_CUDA_GRAPHS (a StaticCache);
+# with the default growing DynamicCache every decode step would recompile.
+USE_TORCH_COMPILE = os.getenv("USE_TORCH_COMPILE", "0").lower() in ("1", "true", "yes")
+
 def detect_device():
     """
     Detects the best available device (CUDA, MPS, or CPU).
@@ -29,28 +41,110 @@ def detect_device():
     else:
         return 'cpu'
 
-def load_model(model_choice):
+def supports_flash_attention():
+    """
+    Returns True if FlashAttention-2 is enabled and usable on this machine.
+    """
+    if not USE_FLASH_ATTN or not torch.cuda.is_available():
+        return False
+    if torch.cuda.get_device_capability()[0] < 8:
+        logger.info("GPU older than Ampere; FlashAttention-2 disabled.")
+        return False
+    try:
+        import flash_attn  # noqa: F401
+    except ImportError:
+        logger.info("flash_attn is not installed; FlashAttention-2 disabled.")
+        return False
+    return True
+
+def get_quantization_config(quantization):
+    """
+    Returns the bitsandbytes config for a quantization choice ('none', '8bit' or '4bit').
+    The vision tower is kept unquantized so image features stay accurate.
+    """
+    if quantization == '4bit':
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_use_double_quant=True,
+            llm_int8_skip_modules=["visual"]
+        )
+    elif quantization == '8bit':
+        return BitsAndBytesConfig(
+            load_in_8bit=True,
+            llm_int8_skip_modules=["visual"]
+        )
+    return None
+
+def unload_model_variants(model_choice):
+    """
+    Removes every cached variant (any quantization) of a model and releases the
+    GPU memory they held.
+    """
+    stale_keys = [key for key in _model_cache if key.split(':')[0] == model_choice]
+    for key in stale_keys:
+        del _model_cache[key]
+        logger.info(f"Model '{key}' unloaded.")
+    if stale_keys:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def load_model(model_choice, quantization='none'):
     """
     Loads and caches the specified model.
+
+    Args:
+        model_choice (str): The model to load.
+        quantization (str): Weight quantization, 'none', '8bit' or '4bit'. Quantization
+            requires CUDA and is ignored on other devices.
     """
     global _model_cache
 
-    if model_choice in _model_cache:
-        logger.info(f"Model '{model_choice}' loaded from cache.")
-        return _model_cache[model_choice]
+    device = detect_device()
+    if quantization not in ('8bit', '4bit') or device != 'cuda':
+        if quantization not in (None, 'none'):
+            logger.warning(f"Quantization '{quantization}' is not available on {device}; loading unquantized model.")
+        quantization = 'none'
+    cache_key = model_choice if quantization == 'none' else f"{model_choice}:{quantization}"
+
+    if cache_key in _model_cache:
+        logger.info(f"Model '{cache_key}' loaded from cache.")
+        return _model_cache[cache_key]
 
     if model_choice == 'qwen':
-        device = detect_device()
+        # Two copies of the 7B model do not fit on one GPU; unload the other variants first
+        unload_model_variants(model_choice)
+        if device == 'cuda':
+            model_kwargs = {
+                "torch_dtype": torch.bfloat16,
+                "device_map": "cuda",
+                "attn_implementation": "flash_attention_2" if supports_flash_attention() else "sdpa",
+            }
+            quantization_config = get_quantization_config(quantization)
+            if quantization_config is not None:
+                model_kwargs["quantization_config"] = quantization_config
+        else:
+            model_kwargs = {
+                "torch_dtype": torch.float16 if device != 'cpu' else torch.float32,
+                "device_map": "auto",
+            }
         model = Qwen2VLForConditionalGeneration.from_pretrained(
             "Qwen/Qwen2-VL-7B-Instruct",
-            torch_dtype=torch.float16 if device != 'cpu' else torch.float32,
-            device_map="auto"
+            **model_kwargs
         )
         processor = AutoProcessor.from_pretrained("Qwen/Qwen2-VL-7B-Instruct")
-        model.to(device)
-        _model_cache[model_choice] = (model, processor, device)
-        logger.info("Qwen model loaded and cached.")
-        return _model_cache[model_choice]
+        if device != 'cuda':
+            model.to(device)
+        model.eval()
+        if device == 'cuda' and USE_TORCH_COMPILE and quantization == 'none':
+            # Compile the forward pass only; generate() keeps running on the original module
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+        logger.info(f"Qwen model loaded with {model_kwargs}.")
+        _model_cache[cache_key] = (model, processor, device)
+        logger.info(f"Qwen model '{cache_key}' loaded and cached.")
+        return _model_cache[cache_key]
     else:
         logger.error(f"Invalid model choice: {model_choice}")
         raise ValueError("Invalid model choice.")
\ No newline at end of file
@@ -0,0 +1,123 @@
+# models/pdf_render.py
+
+import os
+import io
+import sys
+import subprocess
+import tempfile
+from diskcache import Cache
+from PIL import Image
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Extracted PDF text keyed by (path, mtime, size). Filled when a PDF is rendered for
+# indexing so parsing its sections later does not open the PDF a second time.
+PDF_TEXT_CACHE_DIR = os.path.join('cache', 'pdf_text')
+RENDER_DPI = 150
+
+# Directory containing the `models` package, the working directory of render processes
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_text_cache = None
+
+def _get_text_cache():
+    # Opened on first use so render processes never open it
+    global _text_cache
+    if _text_cache is None:
+        _text_cache = Cache(PDF_TEXT_CACHE_DIR)
+    return _text_cache
+
+def _file_key(pdf_path):
+    st = os.stat(pdf_path)
+    return (os.path.abspath(pdf_path), st.st_mtime_ns, st.st_size)
+
+def render_pdf(pdf_path, dpi=RENDER_DPI):
+    """
+    Renders every page of a PDF and extracts its text in a single PyMuPDF pass.
+
+    PyMuPDF is not thread-safe; use render_pdf_in_subprocess to render several
+    PDFs concurrently.
+
+    Args:
+        pdf_path (str): The path to the PDF.
+        dpi (int): Resolution of the rendered pages.
+
+    Returns:
+        tuple: (text, pages) where pages is a list of PNG-encoded pages.
+    """
+    import fitz
+
+    texts = []
+    pages = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            texts.append(page.get_text("text"))
+            pages.append(page.get_pixmap(dpi=dpi).tobytes("png"))
+    return "\n".join(texts), pages
+
+def render_pdf_in_subprocess(pdf_path, dpi=RENDER_DPI):
+    """
+    Runs render_pdf in a separate `python -m models.pdf_render` process.
+
+    Unlike a multiprocessing spawn worker, the process does not re-import the
+    application's main module, so none of its startup code (or torch) runs there.
+    Pages are handed back as PNG files in a temporary directory.
+
+    Args:
+        pdf_path (str): The path to the PDF.
+        dpi (int): Resolution of the rendered pages.
+
+    Returns:
+        tuple: (text, images) where images is a list of PIL images, one per page.
+    """
+    with tempfile.TemporaryDirectory(prefix='pdf_render_') as out_dir:
+        completed = subprocess.run(
+            [sys.executable, '-m', 'models.pdf_render', os.path.abspath(pdf_path), out_dir, str(dpi)],
+            cwd=_PROJECT_ROOT, capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(f"Rendering {pdf_path} failed: {completed.stderr.strip()[-500:]}")
+        with open(os.path.join(out_dir, 'text.txt'), 'r', encoding='utf-8') as f:
+            text = f.read()
+        images = []
+        for filename in sorted(name for name in os.listdir(out_dir) if name.endswith('.png')):
+            with open(os.path.join(out_dir, filename), 'rb') as f:
+                images.append(Image.open(io.BytesIO(f.read())))
+    return text, images
+
+def cache_text(pdf_path, text):
+    """
+    Stores the extracted text of a PDF for later section parsing.
+    """
+    _get_text_cache().set(_file_key(pdf_path), text)
+
+def extract_text(pdf_path):
+    """
+    Returns the text of a PDF, reusing the text extracted during indexing if the
+    file has not changed since.
+    """
+    key = _file_key(pdf_path)
+    text = _get_text_cache().get(key)
+    if text is None:
+        import fitz
+
+        with fitz.open(pdf_path) as doc:
+            text = "\n".join(page.get_text("text") for page in doc)
+        _get_text_cache().set(key, text)
+    return text
+
+def _main(argv):
+    # python -m models.pdf_render <pdf_path> <out_dir> [dpi]
+    pdf_path, out_dir = argv[0], argv[1]
+    dpi = int(argv[2]) if len(argv) > 2 else RENDER_DPI
+    text, pages = render_pdf(pdf_path, dpi)
+    for i, page in enumerate(pages):
+        with open(os.path.join(out_dir, f"page_{i:05d}.png"), 'wb') as f:
+            f.write(page)
+    # Written last: its presence means all pages were written
+    with open(os.path.join(out_dir, 'text.txt'), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+if __name__ == '__main__':
+    _main(sys.argv[1:])
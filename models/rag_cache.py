@@ -0,0 +1,79 @@
+# models/rag_cache.py
+
+import os
+import hashlib
+from diskcache import Cache
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Two-tier cache for the chat route:
+#   ("ret", ...) maps a normalized query to the retrieved image paths,
+#   ("ans", ...) maps query + retrieved images + generation settings to the answer HTML.
+# Every entry is tagged with its session_id so a session can be evicted at once,
+# and keyed on the session's index_version so re-indexing invalidates old entries.
+RAG_CACHE_DIR = os.path.join('.cache', 'rag')
+RAG_CACHE_EXPIRE = 3600  # seconds
+
+_cache = Cache(RAG_CACHE_DIR, tag_index=True)
+
+def normalize_query(query):
+    """
+    Normalizes a query for cache lookups (case and whitespace insensitive).
+    """
+    return " ".join(query.lower().split())
+
+def _digest(value):
+    return hashlib.blake2b(repr(value).encode('utf-8'), digest_size=16).hexdigest()
+
+def query_key(query):
+    """
+    Returns the hash of the normalized query.
+    """
+    return _digest(normalize_query(query))
+
+def get_retrieval(session_id, index_version, qkey):
+    """
+    Returns the cached retrieved image paths for the query, or None.
+    """
+    return _cache.get(("ret", session_id, index_version, qkey))
+
+def set_retrieval(session_id, index_version, qkey, retrieved_images):
+    """
+    Caches the retrieved image paths for the query.
+    """
+    _cache.set(("ret", session_id, index_version, qkey), list(retrieved_images),
+               expire=RAG_CACHE_EXPIRE, tag=session_id)
+
+def _answer_key(session_id, index_version, qkey, retrieved_images, generation_model,
+                answer_length, resized_height, resized_width):
+    answer_hash = _digest((qkey, tuple(sorted(retrieved_images)), generation_model,
+                           answer_length, resized_height, resized_width))
+    return ("ans", session_id, index_version, answer_hash)
+
+def get_answer(session_id, index_version, qkey, retrieved_images, generation_model,
+               answer_length, resized_height, resized_width):
+    """
+    Returns the cached answer HTML for the query and retrieved pages, or None.
+    """
+    return _cache.get(_answer_key(session_id, index_version, qkey, retrieved_images,
+                                  generation_model, answer_length, resized_height, resized_width))
+
+def set_answer(session_id, index_version, qkey, retrieved_images, generation_model,
+               answer_length, resized_height, resized_width, parsed_response):
+    """
+    Caches the answer HTML for the query and retrieved pages.
+    """
+    _cache.set(_answer_key(session_id, index_version, qkey, retrieved_images,
+                           generation_model, answer_length, resized_height, resized_width),
+               str(parsed_response), expire=RAG_CACHE_EXPIRE, tag=session_id)
+
+def invalidate_session(session_id):
+    """
+    Removes all cached retrievals and answers for a session.
+    """
+    try:
+        removed = _cache.evict(session_id)
+        logger.info(f"Evicted {removed} cached RAG entries for session {session_id}.")
+    except Exception as e:
+        logger.error(f"Error evicting RAG cache for session {session_id}: {e}")
@@ -1,11 +1,17 @@
 # models/responder.py
 
-from models.model_loader import load_model
+from models.model_loader import load_model, USE_TORCH_COMPILE
 from transformers import GenerationConfig
 from dotenv import load_dotenv
 from logger import get_logger
 from openai import OpenAI
 from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import contextlib
+import hashlib
+import mimetypes
 import torch
 import base64
 import os
@@ -13,14 +19,118 @@ import io
 
 logger = get_logger(__name__)
 
+# Per-session KV cache of the image prefix for the Qwen model, keyed by the
+# retrieved image set. Entries hold (past_key_values, prefix_ids, rope_deltas).
+KV_CACHE = OrderedDict()
+KV_CACHE_MAX_ENTRIES = 4  # KV tensors are large, keep only a few around
+_kv_cache_lock = threading.Lock()
+
+# Opt-in, with USE_TORCH_COMPILE: decode short answers into a fixed-size StaticCache so the
+# compiled forward (mode="reduce-overhead") captures and replays a CUDA graph per decode step. A static
+# cache cannot be cropped back to the image prefix, so these calls do not populate KV_CACHE.
+USE_DECODE_CUDA_GRAPHS = os.getenv("USE_DECODE_CUDA_GRAPHS", "0").lower() in ("1", "true", "yes")
+STATIC_CACHE_BUCKET = 256  # tokens; rounding keeps the decode shapes stable across queries
+
+# Shared pool for decoding retrieved images; Pillow releases the GIL while decoding
+_image_executor = ThreadPoolExecutor(max_workers=4)
+
+class GenerationError(Exception):
+    """
+    Raised when no answer could be generated. The message is suitable for
+    showing to the user in place of the answer.
+    """
+
 # Function to encode the image
 def encode_image(image_path):
   with open(image_path, "rb") as image_file:
     return base64.b64encode(image_file.read()).decode('utf-8')
 
-def generate_response(images, query, session_id, resized_height=280, resized_width=280, model_choice='qwen', answer_length='short'):
+def _load_image(image_path, size):
+    with Image.open(image_path) as image:
+        return image.convert("RGB").resize(size, Image.BILINEAR)
+
+def preload_images(image_paths, resized_height, resized_width):
+    """
+    Opens and resizes the images in parallel.
+
+    Args:
+        image_paths (list): Paths of the images to load.
+        resized_height (int): Target height in pixels.
+        resized_width (int): Target width in pixels.
+
+    Returns:
+        list: RGB PIL images in the same order as image_paths.
+    """
+    size = (resized_width, resized_height)
+    return list(_image_executor.map(lambda path: _load_image(path, size), image_paths))
+
+def _static_cache(model, prompt_len, max_new_tokens, device):
+    """
+    Builds a StaticCache sized to the prompt plus answer, rounded up to
+    STATIC_CACHE_BUCKET so queries with the same images share a captured graph.
+    """
+    from transformers import StaticCache
+
+    max_cache_len = -(-(prompt_len + max_new_tokens) // STATIC_CACHE_BUCKET) * STATIC_CACHE_BUCKET
+    return StaticCache(config=model.config, max_batch_size=1, max_cache_len=max_cache_len,
+                       device=device, dtype=model.dtype)
+
+def _kv_cache_key(session_id, images, resized_height, resized_width, model_choice='qwen'):
+    """
+    Builds the KV cache key for a session's retrieved image set.
+    """
+    key = repr((model_choice, session_id, tuple(sorted(images)), resized_height, resized_width))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+def _vision_prefix_length(input_ids, model):
+    """
+    Returns the number of prompt tokens up to and including the last image,
+    i.e. the part of the prompt that does not depend on the query text.
+    """
+    vision_end_id = getattr(model.config, 'vision_end_token_id', None)
+    if vision_end_id is None:
+        return 0
+    positions = (input_ids == vision_end_id).nonzero()
+    if len(positions) == 0:
+        return 0
+    return int(positions[-1]) + 1
+
+def _take_kv_cache(key, prefix_ids):
+    """
+    Removes and returns the cached prefix for the key, or None on a miss.
+    The entry is taken out while in use so concurrent requests never share it.
+    """
+    with _kv_cache_lock:
+        entry = KV_CACHE.pop(key, None)
+    if entry is None:
+        return None
+    past_key_values, cached_ids, rope_deltas = entry
+    if not torch.equal(cached_ids, prefix_ids):
+        logger.debug(f"KV cache entry {key} does not match the prompt prefix; discarding.")
+        return None
+    return past_key_values, rope_deltas
+
+def _store_kv_cache(key, past_key_values, prefix_ids, rope_deltas):
+    """
+    Stores a prefix KV cache, evicting the least recently used entries.
+    """
+    with _kv_cache_lock:
+        KV_CACHE[key] = (past_key_values, prefix_ids, rope_deltas)
+        KV_CACHE.move_to_end(key)
+        while len(KV_CACHE) > KV_CACHE_MAX_ENTRIES:
+            evicted_key, _ = KV_CACHE.popitem(last=False)
+            logger.debug(f"Evicted KV cache entry {evicted_key}.")
+
+def generate_response(images, query, session_id, resized_height=280, resized_width=280, model_choice='qwen', answer_length='short', quantization='none', image_urls=None):
     """
     Generates a response using the selected model based on the query and images.
+
+    For the gpt4 model, image_urls can hold publicly reachable URLs of the images;
+    they are sent instead of inlining the image bytes as base64.
+
+    Raises:
+        GenerationError: If no answer could be generated, so failures are never
+            mistaken for (and cached as) answers.
     """
     try:
         logger.info(f"Generating response using model '{model_choice}' with answer length '{answer_length}'.")
@@ -37,23 +147,25 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
         
         if not valid_images:
             logger.warning("No valid images found for analysis.")
-            return "No images could be loaded for analysis."
+            raise GenerationError("No images could be loaded for analysis.")
         
     
 
         if model_choice == 'qwen':
             from qwen_vl_utils import process_vision_info
             # Load cached model
-            model, processor, device = load_model('qwen')
+            model, processor, device = load_model('qwen', quantization=quantization)
             # Ensure dimensions are multiples of 28
             resized_height = (resized_height // 28) * 28
             resized_width = (resized_width // 28) * 28
 
+            # Decode all images up front in parallel instead of one by one in process_vision_info
+            loaded_images = preload_images(valid_images, resized_height, resized_width)
             image_contents = []
-            for image in valid_images:
+            for image in loaded_images:
                 image_contents.append({
                     "type": "image",
-                    "image": image,  # Use the full path
+                    "image": image,
                     "resized_height": resized_height,
                     "resized_width": resized_width
                 })
@@ -72,7 +184,20 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 padding=True,
                 return_tensors="pt",
             )
-            inputs = inputs.to(device)
+            # Reuse the KV cache of the image prefix when the same pages were
+            # retrieved earlier in this session; only the query gets prefilled.
+            # The prefix is found on the CPU copy of the prompt, before the transfer.
+            prefix_len = _vision_prefix_length(inputs.input_ids[0], model)
+            prefix_ids = inputs.input_ids[0, :prefix_len].clone()
+            if device == 'cuda':
+                # Pinned host memory lets the copy to the GPU run asynchronously,
+                # overlapping with the KV cache lookup below
+                for name, value in inputs.items():
+                    if isinstance(value, torch.Tensor):
+                        inputs[name] = value.pin_memory()
+                inputs = inputs.to(device, non_blocking=True)
+            else:
+                inputs = inputs.to(device)
             # Determine max_new_tokens based on answer_length
             if answer_length == 'short':
                 max_new_tokens = 128
@@ -80,7 +205,43 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 max_new_tokens = 500
             else:
                 max_new_tokens = 128  # Default to short if invalid value
-            generated_ids = model.generate(**inputs, max_new_tokens=max_new_tokens)
+
+            kv_key = _kv_cache_key(session_id, valid_images, resized_height, resized_width,
+                                   model_choice=f"qwen:{quantization}")
+            cached = _take_kv_cache(kv_key, prefix_ids) if prefix_len else None
+            generate_kwargs = {}
+            if cached is not None:
+                past_key_values, rope_deltas = cached
+                model.rope_deltas = rope_deltas
+                generate_kwargs['past_key_values'] = past_key_values
+                logger.info(f"KV cache hit for {len(valid_images)} images; reusing {prefix_len} prefix tokens.")
+            elif (USE_DECODE_CUDA_GRAPHS and USE_TORCH_COMPILE and device == 'cuda'
+                  and quantization == 'none' and answer_length == 'short'):
+                generate_kwargs['past_key_values'] = _static_cache(
+                    model, inputs.input_ids.shape[1], max_new_tokens, device
+                )
+
+            if device == 'cuda':
+                autocast = torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+            else:
+                autocast = contextlib.nullcontext()
+            with torch.inference_mode(), autocast:
+                outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    use_cache=True,
+                    return_dict_in_generate=True,
+                    output_hidden_states=False,
+                    **generate_kwargs
+                )
+            generated_ids = outputs.sequences
+
+            if prefix_len and outputs.past_key_values is not None and hasattr(outputs.past_key_values, 'crop'):
+                # Drop the query and answer tokens so only the image prefix is kept
+                past_key_values = outputs.past_key_values
+                past_key_values.crop(prefix_len)
+                _store_kv_cache(kv_key, past_key_values, prefix_ids, getattr(model, 'rope_deltas', None))
+
             generated_ids_trimmed = [
                 out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
             ]
@@ -91,11 +252,6 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
             return output_text[0]
         
         elif model_choice == 'gpt4':
-            api_key = os.getenv("OPENAI_API_KEY")
-            openai.api_key =api_key
-            
-            
-            
             # Determine max_tokens based on answer_length
             max_tokens = 128 if answer_length == 'short' else 500
 
@@ -104,23 +260,24 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 {"type": "text", "text": query}
             ]
 
-            # Add images to the content
-            for img_path in images:
-                with open(img_path, "rb") as img_file:
-                    image_bytes = img_file.read()
-                    encoded_image = base64.b64encode(image_bytes).decode('utf-8')
+            # Add images to the content, by URL when available so the request
+            # body does not carry the base64-encoded image bytes
+            if image_urls:
+                for url in image_urls:
+                    content.append({"type": "image_url", "image_url": {"url": url}})
+            else:
+                for img_path in valid_images:
+                    mime_type = mimetypes.guess_type(img_path)[0] or 'image/png'
                     content.append({
-                        "type": "image",
-                        "image": {
-                            "bytes": encoded_image
-                        }
+                        "type": "image_url",
+                        "image_url": {"url": f"data:{mime_type};base64,{encode_image(img_path)}"}
                     })
 
             messages = [
                 {"role": "user", "content": content}
             ]
 
-            # Send the request to OpenAI API
+            # Send the request to OpenAI API; the client reads OPENAI_API_KEY from the environment
             client = OpenAI()
             response = client.chat.completions.create(
                 model="gpt-4o",
@@ -129,13 +286,15 @@ def generate_response(images, query, session_id, resized_height=280, resized_wid
                 temperature=0.7
             )
 
-            generated_text = response['choices'][0]['message']['content']
+            generated_text = response.choices[0].message.content
             logger.info("Response generated using GPT-4 with Vision model.")
             return generated_text
             
         else:
             logger.error(f"Invalid model choice: {model_choice}")
-            return "Invalid model selected."
+            raise GenerationError("Invalid model selected.")
+    except GenerationError:
+        raise
     except Exception as e:
         logger.error(f"Error generating response: {e}")
-        return f"An error occurred while generating the response: {str(e)}"
+        raise GenerationError(f"An error occurred while generating the response: {str(e)}") from e
@@ -2,17 +2,69 @@
 
 import base64
 import os
+import re
 from diskcache import Cache
 from PIL import Image
 from io import BytesIO
 from logger import get_logger
 import time
 import hashlib
-import pickle
 import numpy as np
+import uuid
+import queue
+import threading
+import weakref
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from models.indexer import normalize_embedding, quantize_embedding
 
 logger = get_logger(__name__)
 
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+    logger.info("simsimd is not installed; page similarity falls back to NumPy.")
+
+# With simsimd, pages are first scanned on their int8-quantized embeddings; the best
+# INT8_RESCORE_FACTOR * k candidates are then rescored exactly on the float32 rows.
+USE_INT8_EMBEDDINGS = os.getenv("USE_INT8_EMBEDDINGS", "1").lower() in ("1", "true", "yes")
+INT8_RESCORE_FACTOR = 4
+
+# Normalized query embeddings per (RAG model, query string); repeated queries skip the encoder
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+_rag_registry = weakref.WeakValueDictionary()
+
+# After a retrieval, the pages adjacent to the retrieved ones are read in the background
+# so that follow-up questions about the same passage hit the OS page cache.
+PREFETCH_QUEUE_SIZE = 64
+_prefetch_queue = queue.Queue(maxsize=PREFETCH_QUEUE_SIZE)
+_prefetch_thread = None
+_prefetch_lock = threading.Lock()
+
+_UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9._-]')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Shared pool for saving retrieved pages; Pillow releases the GIL while encoding
+_save_executor = ThreadPoolExecutor(max_workers=4)
+
+try:
+    import blake3
+
+    def content_hash(data):
+        """
+        Returns a 32 hex character hash of the bytes (BLAKE3, SIMD accelerated).
+        """
+        return blake3.blake3(data).hexdigest(16)
+except ImportError:
+    def content_hash(data):
+        """
+        Returns a 32 hex character hash of the bytes (BLAKE2b, when blake3 is not installed).
+        """
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
 def retrieve_documents(RAG, query, session_id, k=3):
     """
     Retrieves relevant documents based on the user query using Byaldi.
@@ -29,12 +81,13 @@ def retrieve_documents(RAG, query, session_id, k=3):
     try:
         logger.info(f"Retrieving documents for query: {query}")
         
-        if hasattr(RAG, 'use_disk_storage') and RAG.use_disk_storage:
+        use_disk = getattr(RAG, 'use_disk_storage', False)
+        if use_disk:
             results = retrieve_from_disk(RAG, query, k)
         else:
             results = RAG.search(query, k=k)
         
-        images = process_results(results, RAG, session_id)
+        images = process_results(results, use_disk, session_id)
         
         logger.info(f"Total {len(images)} documents retrieved. Image paths: {images}")
         return images
@@ -43,57 +96,105 @@ def retrieve_documents(RAG, query, session_id, k=3):
         logger.error(f"AttributeError in retrieve_documents: {e}")
         logger.info("Falling back to default search method")
         results = RAG.search(query, k=k)
-        images = process_results(results, RAG, session_id)
+        images = process_results(results, False, session_id)
         return images
 
     except Exception as e:
         logger.error(f"Error retrieving documents: {e}")
         return []
 
-def process_results(results, RAG, session_id):
+def process_results(results, use_disk, session_id):
     """
     Process the search results and save images.
 
     Args:
         results (list): The search results.
-        RAG (RAGMultiModalModel): The RAG model.
+        use_disk (bool): Whether the results come from retrieve_from_disk
+            rather than RAG.search.
         session_id (str): The session ID.
 
     Returns:
         list: A list of image filenames.
     """
-    images = []
     session_images_folder = os.path.join('static', 'images', session_id)
     os.makedirs(session_images_folder, exist_ok=True)
 
+    extract_image_data = _image_data_from_disk if use_disk else _image_data_from_base64
+    pages = []
     for result in results:
-        if hasattr(RAG, 'use_disk_storage') and RAG.use_disk_storage:
-            image_data = result['image']
-        elif hasattr(result, 'base64') and result.base64:
-            image_data = base64.b64decode(result.base64)
-        else:
+        image_data, image_filename = extract_image_data(result)
+        if image_data is None:
             logger.warning(f"No image data for document {getattr(result, 'doc_id', 'unknown')}, page {getattr(result, 'page_num', 'unknown')}")
             continue
+        pages.append((image_data, image_filename))
 
-        image = Image.open(BytesIO(image_data))
-        
+    # Joined once here instead of per image
+    image_prefix = session_images_folder + os.sep
+    relative_prefix = os.path.join('images', session_id) + os.sep
+
+    # Hash, encode and write the pages concurrently; map keeps the retrieval order
+    images = list(_save_executor.map(
+        lambda page: save_result_image(page[0], image_prefix, relative_prefix, page[1]), pages
+    ))
+    for relative_path in images:
+        logger.debug("Added image to list: %s", relative_path)
+
+    return images
+
+def _image_data_from_disk(result):
+    # Disk results name the page: key plus the digest stored with the image at indexing
+    # time, so the image bytes do not need hashing; the digest keeps a re-indexed file
+    # with the same name from reusing a stale copy.
+    image_data = result.get('image')
+    digest = result.get('digest')
+    if image_data is None or not digest:
+        return image_data, None
+    page_key = result['key']
+    if page_key.endswith('_embedding'):
+        page_key = page_key[:-len('_embedding')]
+    return image_data, f"retrieved_{_UNSAFE_FILENAME_CHARS.sub('_', page_key)}_{digest}.png"
+
+def _image_data_from_base64(result):
+    encoded = getattr(result, 'base64', None)
+    return (base64.b64decode(encoded) if encoded else None), None
+
+def save_result_image(image_data, image_prefix, relative_prefix, image_filename=None):
+    """
+    Saves a retrieved page image under a name derived from its content.
+
+    Args:
+        image_data (bytes): The encoded image.
+        image_prefix (str): The session's image folder, ending in a path separator.
+        relative_prefix (str): The same folder relative to the static folder,
+            ending in a path separator.
+        image_filename (str): A filename that already identifies the image;
+            when None, it is derived from a hash of image_data.
+
+    Returns:
+        str: The path of the image relative to the static folder.
+    """
+    if image_filename is None:
         # Generate a unique filename based on the image content
-        image_hash = hashlib.md5(image_data).hexdigest()
-        image_filename = f"retrieved_{image_hash}.png"
-        image_path = os.path.join(session_images_folder, image_filename)
-        
-        if not os.path.exists(image_path):
-            image.save(image_path, format='PNG')
-            logger.debug(f"Retrieved and saved image: {image_path}")
+        image_filename = f"retrieved_{content_hash(image_data)}.png"
+    image_path = image_prefix + image_filename
+
+    if os.path.exists(image_path):
+        logger.debug("Image already exists: %s", image_path)
+    else:
+        # Written under a temporary name and renamed, so concurrent requests never serve a partial file
+        tmp_path = f"{image_path}.{uuid.uuid4().hex}.tmp"
+        if image_data[:8] == PNG_SIGNATURE:
+            # Already PNG: write the bytes as they are instead of decoding and re-encoding
+            with open(tmp_path, 'wb') as f:
+                f.write(image_data)
         else:
-            logger.debug(f"Image already exists: {image_path}")
-        
-        # Store the relative path from the static folder
-        relative_path = os.path.join('images', session_id, image_filename)
-        images.append(relative_path)
-        logger.info(f"Added image to list: {relative_path}")
+            # Fast zlib level: these are per-session copies, size matters less than latency
+            Image.open(BytesIO(image_data)).save(tmp_path, format='PNG', optimize=False, compress_level=1)
+        os.replace(tmp_path, image_path)
+        logger.debug("Retrieved and saved image: %s", image_path)
 
-    return images
+    # Store the relative path from the static folder
+    return relative_prefix + image_filename
 
 def retrieve_from_disk(RAG, query, k):
     """
@@ -107,40 +208,150 @@ def retrieve_from_disk(RAG, query, k):
     Returns:
         list: A list of dictionaries containing retrieved document information.
     """
-    query_embedding = RAG.encode_query(query)
+    use_int8 = USE_INT8_EMBEDDINGS and SIMSIMD_AVAILABLE
+    if use_int8:
+        keys, embedding_matrix, embedding_matrix_int8 = RAG.disk_cache.quantized_embedding_index()
+    else:
+        keys, embedding_matrix = RAG.disk_cache.embedding_index()
+    if not keys:
+        return []
+
+    # Stored rows were normalized at ingest; normalizing the query makes scores cosines
+    query_embedding = encode_query(RAG, query)
+
+    if use_int8:
+        # int8 pass over the whole corpus, float32 only for the shortlisted candidates
+        distances = simsimd.cdist(quantize_embedding(query_embedding).reshape(1, -1),
+                                  embedding_matrix_int8, metric='cosine')
+        # Sorted so the float32 rows are read from the memmap in file order
+        candidates = np.sort(top_k_indices(-np.asarray(distances).ravel(), k * INT8_RESCORE_FACTOR))
+        candidate_scores = np.asarray(embedding_matrix[candidates] @ query_embedding)
+        best = top_k_indices(candidate_scores, k)
+        top, top_scores = candidates[best], candidate_scores[best]
+    else:
+        scores = similarity_scores(embedding_matrix, query_embedding)
+        top = top_k_indices(scores, k)
+        top_scores = scores[top]
+
+    # Images are only loaded for the top k pages
+    top_keys = [keys[i] for i in top]
+    top_pages = RAG.disk_cache.get_pages(top_keys)
+    prefetch_pages(RAG.disk_cache, neighbor_pages(top_keys))
     results = []
+    for i, score, (image, digest) in zip(top, top_scores, top_pages):
+        results.append({
+            'similarity': float(score),
+            'image': image,
+            'digest': digest,
+            'key': f"{keys[i]}_embedding"
+        })
+    return results
+
+@functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _encode_query_cached(rag_id, query):
+    query_embedding = normalize_embedding(_rag_registry[rag_id].encode_query(query))
+    query_embedding.setflags(write=False)  # Shared between callers
+    return query_embedding
+
+def _forget_rag(rag_id):
+    # A later model can reuse the id; lru_cache cannot drop single entries
+    _encode_query_cached.cache_clear()
+
+def encode_query(RAG, query):
+    """
+    Returns the normalized, read-only embedding of the query, cached per model.
+
+    Args:
+        RAG (RAGMultiModalModel): The RAG model used to encode the query.
+        query (str): The user's query.
 
-    for key in RAG.disk_cache.cache.iterkeys():
-        if key.endswith('_embedding'):
-            embedding = pickle.loads(RAG.disk_cache.cache.get(key))
-            similarity = compute_similarity(query_embedding, embedding)
-            image_key = key.replace('_embedding', '_image')
-            image = pickle.loads(RAG.disk_cache.cache.get(image_key))
-            results.append({
-                'similarity': similarity,
-                'image': image,
-                'key': key
-            })
-
-    # Sort results by similarity and return top k
-    results.sort(key=lambda x: x['similarity'], reverse=True)
-    return results[:k]
-
-def compute_similarity(query_embedding, document_embedding):
+    Returns:
+        np.array: Unit-norm float32 query embedding.
+    """
+    rag_id = id(RAG)
+    if _rag_registry.get(rag_id) is not RAG:
+        _rag_registry[rag_id] = RAG
+        weakref.finalize(RAG, _forget_rag, rag_id)
+    return _encode_query_cached(rag_id, query)
+
+def similarity_scores(embedding_matrix, query_embedding):
     """
-    Compute the cosine similarity between query and document embeddings.
+    Computes the cosine similarity of the query with every row of the matrix.
 
     Args:
-        query_embedding (np.array): The embedding of the query.
-        document_embedding (np.array): The embedding of the document.
+        embedding_matrix (np.array): (N, D) matrix of unit-norm page embeddings.
+        query_embedding (np.array): Unit-norm query embedding of length D.
 
     Returns:
-        float: The cosine similarity between the embeddings.
+        np.array: N similarity scores.
+    """
+    if SIMSIMD_AVAILABLE:
+        # SIMD cosine kernels (AVX-512 / NEON) over the whole matrix in one call
+        distances = simsimd.cdist(query_embedding.reshape(1, -1), embedding_matrix, metric='cosine')
+        return 1.0 - np.asarray(distances).ravel()
+    # Rows are unit-norm, so one matrix-vector product gives every cosine similarity
+    return embedding_matrix @ query_embedding
+
+def neighbor_pages(page_keys):
     """
-    return np.dot(query_embedding, document_embedding) / (
-        np.linalg.norm(query_embedding) * np.linalg.norm(document_embedding)
-    )
+    Returns the keys of the pages before and after each page (keys are '<file>_<page>'),
+    excluding the pages themselves.
+    """
+    neighbors = []
+    for key in page_keys:
+        file, _, page = key.rpartition('_')
+        if page.isdigit():
+            for neighbor in (int(page) - 1, int(page) + 1):
+                if neighbor >= 0:
+                    neighbors.append(f"{file}_{neighbor}")
+    seen = set(page_keys)
+    return [key for key in neighbors if not (key in seen or seen.add(key))]
+
+def _prefetch_loop():
+    while True:
+        disk_cache, key = _prefetch_queue.get()
+        try:
+            # Read only for the side effect of warming the page cache
+            disk_cache.cache.get(f"{key}_image")
+        except Exception as e:
+            logger.debug(f"Prefetch of {key} failed: {e}")
+
+def prefetch_pages(disk_cache, page_keys):
+    """
+    Queues pages to be read in the background. Pages are dropped when the queue is full.
+    """
+    global _prefetch_thread
+    with _prefetch_lock:
+        # Started lazily so it also runs in processes forked after import (gunicorn --preload)
+        if _prefetch_thread is None or not _prefetch_thread.is_alive():
+            _prefetch_thread = threading.Thread(target=_prefetch_loop, name="page-prefetcher", daemon=True)
+            _prefetch_thread.start()
+    for key in page_keys:
+        try:
+            _prefetch_queue.put_nowait((disk_cache, key))
+        except queue.Full:
+            break
+
+def top_k_indices(scores, k):
+    """
+    Returns the indices of the k highest scores, highest first.
 
+    Args:
+        scores (np.array): The similarity scores.
+        k (int): The number of indices to return.
+
+    Returns:
+        np.array: Indices into scores.
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    negated = -np.asarray(scores)
+    if k < len(negated):
+        # O(N) partition; only the k survivors are sorted
+        top = np.argpartition(negated, k - 1)[:k]
+    else:
+        top = np.arange(len(negated))
+    return top[np.argsort(negated[top], kind='stable')]
 
 # # models/retriever.py
 
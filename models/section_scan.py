@@ -0,0 +1,170 @@
+# models/section_scan.py
+
+import re
+import numpy as np
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    logger.info("numba is not installed; section parsing falls back to the regex scanner.")
+
+# Line-level section heading, e.g. "Section 2.1 Scope" or "3.4 Results". Matched on str,
+# where \s and \d (and str.strip) also cover Unicode whitespace and digits such as NBSP;
+# used by the fallback parser and for lines the byte scanner cannot decide.
+_SECHEAD_RE = re.compile(r'(?:Section\s+)?(\d+(?:\.\d+)*)')
+
+if NUMBA_AVAILABLE:
+    _SECTION_WORD = np.frombuffer(b'Section', dtype=np.uint8)
+
+    @njit(cache=True)
+    def _is_space(c):
+        # space, \t, \n, \v, \f, \r
+        return c == 32 or (9 <= c <= 13)
+
+    @njit(cache=True)
+    def _is_digit(c):
+        return 48 <= c <= 57
+
+    @njit(cache=True)
+    def scan_sections(buf):
+        """
+        Scans a UTF-8 buffer for lines that start with a section number.
+
+        Args:
+            buf (np.ndarray): The text as a uint8 array.
+
+        Returns:
+            np.ndarray: One (line_start, line_end, id_start, id_end) row per heading line,
+            where line_end is the offset of the terminating newline (or len(buf)).
+            Lines with non-ASCII bytes or the ASCII separators 0x1c-0x1f, which are
+            whitespace in str but not in bytes, are returned with id_start = -1 to be
+            checked on the decoded text.
+        """
+        n = buf.shape[0]
+        max_lines = 1
+        for i in range(n):
+            if buf[i] == 10:
+                max_lines += 1
+        out = np.empty((max_lines, 4), dtype=np.int64)
+        count = 0
+        word_len = _SECTION_WORD.shape[0]
+
+        line_start = 0
+        while line_start <= n:
+            line_end = line_start
+            while line_end < n and buf[line_end] != 10:
+                line_end += 1
+
+            undecided = False
+            for c in range(line_start, line_end):
+                if buf[c] >= 128 or (28 <= buf[c] <= 31):
+                    undecided = True
+                    break
+            if undecided:
+                out[count, 0] = line_start
+                out[count, 1] = line_end
+                out[count, 2] = -1
+                out[count, 3] = -1
+                count += 1
+                line_start = line_end + 1
+                continue
+
+            i = line_start
+            while i < line_end and _is_space(buf[i]):
+                i += 1
+
+            # Optional "Section" followed by at least one whitespace character
+            id_start = i
+            if i + word_len < line_end:
+                is_word = True
+                for w in range(word_len):
+                    if buf[i + w] != _SECTION_WORD[w]:
+                        is_word = False
+                        break
+                if is_word:
+                    j = i + word_len
+                    while j < line_end and _is_space(buf[j]):
+                        j += 1
+                    if j > i + word_len and j < line_end and _is_digit(buf[j]):
+                        id_start = j
+
+            if id_start < line_end and _is_digit(buf[id_start]):
+                p = id_start
+                while p < line_end and _is_digit(buf[p]):
+                    p += 1
+                while p + 1 < line_end and buf[p] == 46 and _is_digit(buf[p + 1]):
+                    p += 1
+                    while p < line_end and _is_digit(buf[p]):
+                        p += 1
+                out[count, 0] = line_start
+                out[count, 1] = line_end
+                out[count, 2] = id_start
+                out[count, 3] = p
+                count += 1
+
+            line_start = line_end + 1
+        return out[:count]
+
+    # Compile at import so the first request does not pay the JIT warmup
+    scan_sections(np.frombuffer(b'1\n', dtype=np.uint8))
+
+def _parse_sections_regex(text):
+    sections = {}
+    current_section = None
+    body = []
+    for line in text.split('\n'):
+        section_match = _SECHEAD_RE.match(line.strip())
+        if section_match:
+            if current_section is not None:
+                sections[current_section] = ''.join(body)
+            current_section = section_match.group(1)
+            sections[current_section] = ''
+            body = []
+        elif current_section is not None:
+            body.append(line + '\n')
+    if current_section is not None:
+        sections[current_section] = ''.join(body)
+    return sections
+
+def parse_sections(text):
+    """
+    Splits text into sections keyed by section number.
+
+    A line starting with a section number (optionally prefixed by "Section")
+    begins a new section; the following lines up to the next heading are its text.
+
+    Args:
+        text (str): The document text.
+
+    Returns:
+        dict: Section number -> section text.
+    """
+    if not NUMBA_AVAILABLE:
+        return _parse_sections_regex(text)
+
+    buf = text.encode('utf-8')
+    n = len(buf)
+    headings = []
+    for line_start, line_end, id_start, id_end in scan_sections(np.frombuffer(buf, dtype=np.uint8)).tolist():
+        if id_start >= 0:
+            headings.append((line_start, line_end, buf[id_start:id_end].decode('ascii')))
+            continue
+        section_match = _SECHEAD_RE.match(buf[line_start:line_end].decode('utf-8').strip())
+        if section_match:
+            headings.append((line_start, line_end, section_match.group(1)))
+
+    sections = {}
+    for h, (line_start, line_end, section_id) in enumerate(headings):
+        if line_end >= n:
+            # Heading on the last line without a newline: the section is empty
+            sections[section_id] = ''
+        elif h + 1 < len(headings):
+            sections[section_id] = buf[line_end + 1:headings[h + 1][0]].decode('utf-8')
+        else:
+            sections[section_id] = buf[line_end + 1:].decode('utf-8') + '\n'
+    return sections
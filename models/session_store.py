@@ -0,0 +1,321 @@
+# models/session_store.py
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    index_version INT DEFAULT 0,
+    updated_at REAL DEFAULT 0,
+    deleted INT DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT,
+    seq INT,
+    role TEXT,
+    content TEXT,
+    images_json TEXT,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE TABLE IF NOT EXISTS indexed_files (
+    session_id TEXT,
+    filename TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_indexed_files_session ON indexed_files(session_id);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    session_id TEXT,
+    hash TEXT,
+    filename TEXT,
+    PRIMARY KEY (session_id, hash)
+);
+"""
+
+# Columns added after the first release of the schema, added to existing databases on open
+MIGRATIONS = {
+    'sessions': [
+        ('updated_at', 'REAL DEFAULT 0'),
+        ('deleted', 'INT DEFAULT 0'),
+    ],
+}
+
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(deleted, updated_at DESC);
+"""
+
+SIDEBAR_LIMIT = 100
+
+class SessionStore:
+    """
+    SQLite-backed storage for chat sessions.
+
+    Each message and indexed file is its own row, so a chat turn only writes the
+    new rows instead of re-serializing the whole session. Writes are queued and
+    committed together by a background thread (see start) every `flush_interval`
+    seconds; every read flushes pending writes first so callers always see their
+    own writes.
+    """
+
+    def __init__(self, db_path, flush_interval=0.1):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self._connect()
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._conn.executescript(INDEXES)
+        self._pending = []
+        self._lock = threading.RLock()
+        self._flusher = None
+        # SQLite connections and threads do not survive fork (e.g. gunicorn --preload)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def start(self):
+        """
+        Starts the background flusher, once per process. Until then queued writes
+        are only committed by flush() and by reads.
+
+        Call it from the process that serves requests: a parent process that only
+        imports the app before forking workers should not keep a flusher running.
+        """
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._stop = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_loop, name="session-store-flusher", daemon=True)
+            self._flusher.start()
+
+    def _after_fork(self):
+        self._connect()
+        self._lock = threading.RLock()
+        self._flusher = None
+
+    def _migrate(self):
+        for table, columns in MIGRATIONS.items():
+            existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            for column, definition in columns:
+                if column not in existing:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    logger.info(f"Added column {table}.{column} to the session database.")
+
+    # **Write batching**
+
+    def _enqueue(self, sql, params=()):
+        with self._lock:
+            self._pending.append((sql, params))
+
+    def flush(self):
+        """
+        Commits all queued writes in a single transaction.
+
+        Each write runs in its own savepoint, so a failing statement is logged and
+        dropped without losing the other writes of the batch. If the transaction
+        itself fails, the batch is put back in the queue for the next flush.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            try:
+                self._conn.execute("BEGIN")
+                for sql, params in pending:
+                    self._conn.execute("SAVEPOINT write")
+                    try:
+                        self._conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        self._conn.execute("ROLLBACK TO write")
+                        logger.error(f"Dropping session write {sql!r}: {e}")
+                    self._conn.execute("RELEASE write")
+                self._conn.execute("COMMIT")
+            except Exception as e:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                self._pending[:0] = pending
+                logger.error(f"Error flushing {len(pending)} session writes: {e}")
+                raise
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                pass  # Already logged; keep the flusher alive
+
+    def close(self):
+        if self._flusher is not None:
+            self._stop.set()
+            self._flusher.join()
+        self.flush()
+        self._conn.close()
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            self.flush()
+            return self._conn.execute(sql, params).fetchall()
+
+    # **Sessions**
+
+    def create_session(self, session_id, name='Untitled Session'):
+        """
+        Creates the session if it does not already exist.
+        """
+        self._enqueue("INSERT OR IGNORE INTO sessions (id, name, index_version, updated_at) VALUES (?, ?, 0, ?)",
+                      (session_id, name, time.time()))
+
+    def rename_session(self, session_id, name):
+        """
+        Renames a session. Returns False if the session does not exist.
+        """
+        if not self.session_exists(session_id):
+            return False
+        self._enqueue("UPDATE sessions SET name = ?, updated_at = ? WHERE id = ?", (name, time.time(), session_id))
+        return True
+
+    def session_exists(self, session_id):
+        return bool(self._query("SELECT 1 FROM sessions WHERE id = ? AND deleted = 0", (session_id,)))
+
+    def get_session(self, session_id):
+        """
+        Returns the session as a dict with session_name, chat_history,
+        indexed_files and index_version, or None if it does not exist.
+        """
+        with self._lock:
+            rows = self._query("SELECT name, index_version FROM sessions WHERE id = ? AND deleted = 0", (session_id,))
+            if not rows:
+                return None
+            name, index_version = rows[0]
+            messages = self._query(
+                "SELECT role, content, images_json FROM messages WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            )
+        chat_history = []
+        for role, content, images_json in messages:
+            message = {"role": role, "content": content}
+            if images_json is not None:
+                message["images"] = json.loads(images_json)
+            chat_history.append(message)
+        return {
+            'session_name': name,
+            'chat_history': chat_history,
+            'indexed_files': self.get_indexed_files(session_id),
+            'index_version': index_version or 0
+        }
+
+    def list_sessions(self, limit=SIDEBAR_LIMIT):
+        """
+        Returns {'id', 'name'} dicts for the most recently updated sessions.
+        """
+        rows = self._query(
+            "SELECT id, name FROM sessions WHERE deleted = 0 ORDER BY updated_at DESC LIMIT ?", (limit,)
+        )
+        return [{'id': s_id, 'name': name} for s_id, name in rows]
+
+    def count_sessions(self):
+        return self._query("SELECT COUNT(*) FROM sessions WHERE deleted = 0")[0][0]
+
+    def delete_session(self, session_id):
+        """
+        Marks a session as deleted. Its rows are removed later by purge_deleted_sessions.
+        """
+        self._enqueue("UPDATE sessions SET deleted = 1 WHERE id = ?", (session_id,))
+
+    def purge_deleted_sessions(self):
+        """
+        Removes all rows belonging to sessions marked as deleted.
+        """
+        deleted = "(SELECT id FROM sessions WHERE deleted = 1)"
+        self._enqueue(f"DELETE FROM messages WHERE session_id IN {deleted}")
+        self._enqueue(f"DELETE FROM indexed_files WHERE session_id IN {deleted}")
+        self._enqueue(f"DELETE FROM file_hashes WHERE session_id IN {deleted}")
+        self._enqueue("DELETE FROM sessions WHERE deleted = 1")
+        self.flush()
+
+    # **Messages**
+
+    def append_message(self, session_id, role, content, images=None):
+        """
+        Appends a message to the end of the session's chat history.
+        """
+        images_json = json.dumps(images) if images is not None else None
+        # The sequence number is computed when the batch is committed, so queued
+        # appends for the same session keep their order.
+        self._enqueue(
+            "INSERT INTO messages (session_id, seq, role, content, images_json) "
+            "SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ? FROM messages WHERE session_id = ?",
+            (session_id, role, str(content), images_json, session_id)
+        )
+        self._enqueue("UPDATE sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id))
+
+    # **Indexed files**
+
+    def add_indexed_files(self, session_id, filenames):
+        for filename in filenames:
+            self._enqueue("INSERT INTO indexed_files (session_id, filename) VALUES (?, ?)",
+                          (session_id, filename))
+
+    def get_indexed_files(self, session_id):
+        rows = self._query("SELECT filename FROM indexed_files WHERE session_id = ? ORDER BY rowid", (session_id,))
+        return [filename for (filename,) in rows]
+
+    def get_file_hashes(self, session_id):
+        """
+        Returns {content_hash: filename} for the files saved in the session.
+        """
+        return dict(self._query("SELECT hash, filename FROM file_hashes WHERE session_id = ?", (session_id,)))
+
+    def add_file_hash(self, session_id, file_hash, filename):
+        """
+        Records the content hash of a saved file, replacing the hash of any
+        earlier file saved under the same name.
+        """
+        self._enqueue("DELETE FROM file_hashes WHERE session_id = ? AND filename = ? AND hash != ?",
+                      (session_id, filename, file_hash))
+        self._enqueue("INSERT OR REPLACE INTO file_hashes (session_id, hash, filename) VALUES (?, ?, ?)",
+                      (session_id, file_hash, filename))
+
+    def set_index_version(self, session_id, index_version):
+        self._enqueue("UPDATE sessions SET index_version = ? WHERE id = ?", (index_version, session_id))
+
+    # **Migration**
+
+    def import_json_sessions(self, session_folder):
+        """
+        Imports legacy per-session JSON files that are not yet in the database.
+        Imported files are renamed to <id>.json.imported so that a session deleted
+        later is not imported again on the next start.
+        """
+        if not os.path.isdir(session_folder):
+            return
+        for file in os.listdir(session_folder):
+            if not file.endswith('.json'):
+                continue
+            session_id = file[:-5]
+            file_path = os.path.join(session_folder, file)
+            if self.session_exists(session_id):
+                os.replace(file_path, file_path + '.imported')
+                continue
+            try:
+                with open(file_path, 'r') as f:
+                    data = json.load(f)
+                self.create_session(session_id, data.get('session_name', 'Untitled Session'))
+                self.set_index_version(session_id, data.get('index_version', 0))
+                for message in data.get('chat_history', []):
+                    self.append_message(session_id, message.get('role'), message.get('content', ''),
+                                        message.get('images'))
+                self.add_indexed_files(session_id, data.get('indexed_files', []))
+                self.flush()
+                os.replace(file_path, file_path + '.imported')
+                logger.info(f"Imported session {session_id} from JSON.")
+            except Exception as e:
+                logger.error(f"Error importing session file {file}: {e}")
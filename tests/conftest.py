@@ -0,0 +1,27 @@
+# tests/conftest.py
+
+import sys
+import types
+
+
+def _stub_module(name, **attributes):
+    # Only for dependencies that are not installed; the real module is used otherwise
+    try:
+        __import__(name)
+    except ImportError:
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+class _MissingRAGMultiModalModel:
+    # Tests that build indexes replace it with a fake model
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        raise NotImplementedError("byaldi is not installed")
+
+    from_index = from_pretrained
+
+
+_stub_module('byaldi', RAGMultiModalModel=_MissingRAGMultiModalModel)
+_stub_module('docx2pdf', convert=lambda *args, **kwargs: None)
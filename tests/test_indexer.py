@@ -0,0 +1,131 @@
+# tests/test_indexer.py
+
+import os
+import pickle
+
+import numpy as np
+import pytest
+from diskcache import Cache
+from PIL import Image
+
+from models import retriever
+from models.indexer import DiskCacheIndexer, normalize_embedding, quantize_embedding
+
+DIM = 32
+
+
+def random_pages(count, seed=0, prefix='doc.pdf'):
+    rng = np.random.default_rng(seed)
+    return [(f"{prefix}_{i}", Image.new('RGB', (4, 4), (i % 256, 0, 0)), rng.standard_normal(DIM))
+            for i in range(count)]
+
+
+def expected_rows(pages):
+    return np.stack([normalize_embedding(embedding) for _, _, embedding in pages])
+
+
+class FakeRAG:
+    use_disk_storage = True
+
+    def __init__(self, disk_cache):
+        self.disk_cache = disk_cache
+
+    def encode_query(self, query):
+        return self.queries[query]
+
+
+def test_empty_cache(tmp_path):
+    disk_cache = DiskCacheIndexer(str(tmp_path))
+    keys, matrix = disk_cache.embedding_index()
+    assert keys == []
+    assert matrix.shape[0] == 0
+    keys, matrix, matrix_int8 = disk_cache.quantized_embedding_index()
+    assert keys == [] and matrix_int8.shape[0] == 0
+    # A new cache starts with an empty matrix rather than converting a legacy one
+    assert os.path.exists(disk_cache.matrix_keys_path)
+
+
+def test_store_then_embedding_index(tmp_path):
+    disk_cache = DiskCacheIndexer(str(tmp_path))
+    pages = random_pages(5)
+    disk_cache.store_pages(pages)
+
+    keys, matrix = disk_cache.embedding_index()
+    assert keys == [key for key, _, _ in pages]
+    np.testing.assert_allclose(matrix, expected_rows(pages), rtol=1e-6)
+    stored = disk_cache.get_embedding(pages[0][0])
+    assert stored.dtype == DiskCacheIndexer.EMBEDDING_DTYPE
+    np.testing.assert_allclose(stored, pages[0][2], rtol=1e-3)
+    for image, digest in disk_cache.get_pages(keys):
+        assert isinstance(image, bytes) and digest is not None
+
+
+def test_overwrite_existing_key(tmp_path):
+    disk_cache = DiskCacheIndexer(str(tmp_path))
+    pages = random_pages(4)
+    disk_cache.store_pages(pages)
+    disk_cache.quantized_embedding_index()  # Creates the int8 file, updated in place from now on
+
+    replacement = np.random.default_rng(1).standard_normal(DIM)
+    disk_cache.store_embedding(pages[2][0], replacement)
+    pages[2] = (pages[2][0], pages[2][1], replacement)
+
+    keys, matrix, matrix_int8 = disk_cache.quantized_embedding_index()
+    assert keys == [key for key, _, _ in pages]
+    np.testing.assert_allclose(matrix, expected_rows(pages), rtol=1e-6)
+    np.testing.assert_array_equal(matrix_int8, quantize_embedding(np.asarray(matrix)))
+
+
+def test_reopen_cache(tmp_path):
+    pages = random_pages(6)
+    DiskCacheIndexer(str(tmp_path)).store_pages(pages[:4])
+
+    reopened = DiskCacheIndexer(str(tmp_path))
+    keys, matrix = reopened.embedding_index()
+    assert keys == [key for key, _, _ in pages[:4]]
+    np.testing.assert_allclose(matrix, expected_rows(pages[:4]), rtol=1e-6)
+
+    # Appending through the reopened cache continues after the existing rows
+    reopened.store_pages(pages[4:])
+    keys, matrix = DiskCacheIndexer(str(tmp_path)).embedding_index()
+    assert keys == [key for key, _, _ in pages]
+    np.testing.assert_allclose(matrix, expected_rows(pages), rtol=1e-6)
+
+
+def test_convert_legacy_pickled_cache(tmp_path):
+    # The format written before the matrix file: pickled embeddings and images
+    pages = random_pages(5)
+    with Cache(str(tmp_path)) as legacy:
+        for key, image, embedding in pages:
+            legacy.set(f"{key}_image", pickle.dumps(image))
+            legacy.set(f"{key}_embedding", pickle.dumps(embedding))
+
+    disk_cache = DiskCacheIndexer(str(tmp_path))
+    keys, matrix = disk_cache.embedding_index()
+    rows = dict(zip(keys, np.asarray(matrix)))
+    assert sorted(rows) == sorted(key for key, _, _ in pages)
+    for key, image, embedding in pages:
+        np.testing.assert_allclose(rows[key], normalize_embedding(embedding), rtol=1e-6)
+        assert disk_cache.get_image(key).tobytes() == image.tobytes()
+
+    # Converted once: the matrix files are reused when the cache is reopened
+    assert DiskCacheIndexer(str(tmp_path)).embedding_index()[0] == keys
+
+
+@pytest.mark.skipif(not retriever.SIMSIMD_AVAILABLE, reason="simsimd is not installed")
+def test_quantized_top_k_matches_float32(tmp_path, monkeypatch):
+    disk_cache = DiskCacheIndexer(str(tmp_path))
+    pages = random_pages(300)
+    for start in range(0, len(pages), 50):
+        disk_cache.store_pages(pages[start:start + 50])
+
+    RAG = FakeRAG(disk_cache)
+    rng = np.random.default_rng(2)
+    RAG.queries = {f"q{i}": pages[i * 7][2] + 0.5 * rng.standard_normal(DIM) for i in range(20)}
+
+    def top_keys(use_int8, query):
+        monkeypatch.setattr(retriever, 'USE_INT8_EMBEDDINGS', use_int8)
+        return [result['key'] for result in retriever.retrieve_from_disk(RAG, query, 3)]
+
+    for query in RAG.queries:
+        assert top_keys(True, query) == top_keys(False, query)
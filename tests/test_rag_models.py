@@ -0,0 +1,102 @@
+# tests/test_rag_models.py
+
+import importlib
+import os
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from models import indexer, retriever
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIM = 16
+PAGES = 3
+
+
+class FakeRAG:
+    """
+    Stands in for RAGMultiModalModel: pages and queries get fixed pseudo-random embeddings.
+    """
+    loaded = []
+
+    @classmethod
+    def from_pretrained(cls, indexer_model):
+        cls.loaded.append(indexer_model)
+        return cls()
+
+    def index_document(self, pdf_path):
+        rng = np.random.default_rng(zlib.crc32(os.path.basename(pdf_path).encode()))
+        images = [Image.new('RGB', (4, 4), (i, 0, 0)) for i in range(PAGES)]
+        return images, rng.standard_normal((PAGES, DIM))
+
+    def encode_query(self, query):
+        return np.random.default_rng(zlib.crc32(query.encode())).standard_normal(DIM)
+
+
+@pytest.fixture
+def fake_rag(monkeypatch):
+    FakeRAG.loaded = []
+    monkeypatch.setattr(indexer, 'RAGMultiModalModel', FakeRAG)
+    monkeypatch.setattr(indexer, 'convert_docs_to_pdfs', lambda folder_path: None)
+    monkeypatch.setattr(indexer, '_query_encoders', {})
+    return FakeRAG
+
+
+def build_index(root, session_id, indexer_model='vidore/colpali'):
+    folder = os.path.join(root, 'uploaded_documents', session_id)
+    os.makedirs(folder, exist_ok=True)
+    for name in ('a.pdf', 'b.pdf'):
+        open(os.path.join(folder, f"{session_id}_{name}"), 'wb').close()
+    index_path = os.path.join(root, '.byaldi', session_id)
+    return indexer.index_documents(folder, index_name=session_id, index_path=index_path,
+                                   indexer_model=indexer_model), index_path
+
+
+def result_keys(RAG, query):
+    return [result['key'] for result in retriever.retrieve_from_disk(RAG, query, 3)]
+
+
+def test_reopened_index_matches_indexed_model(tmp_path, fake_rag):
+    RAG, index_path = build_index(str(tmp_path), 's1')
+    assert indexer.is_disk_index(index_path)
+
+    reopened = indexer.open_disk_index(index_path)
+    assert reopened.use_disk_storage
+    for query in ('scope', 'results', 'appendix'):
+        assert result_keys(reopened, query) == result_keys(RAG, query)
+
+
+def test_reopened_indexes_share_encoder(tmp_path, fake_rag):
+    _, first_path = build_index(str(tmp_path), 's1', indexer_model='vidore/colqwen2')
+    _, second_path = build_index(str(tmp_path), 's2', indexer_model='vidore/colqwen2')
+    del fake_rag.loaded[:]
+
+    first = indexer.open_disk_index(first_path)
+    second = indexer.open_disk_index(second_path)
+    assert first.encoder is second.encoder
+    # The model recorded at indexing time, not the default
+    assert fake_rag.loaded == ['vidore/colqwen2']
+
+
+def test_evicted_session_can_be_queried(tmp_path, monkeypatch, fake_rag):
+    for name in ('flask', 'flask_login', 'markdown', 'torch', 'transformers', 'vllm', 'openai', 'dotenv'):
+        pytest.importorskip(name)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(PROJECT_ROOT)
+    app_module = importlib.import_module('app')
+    monkeypatch.setitem(app_module.app.config, 'INDEX_FOLDER', str(tmp_path / '.byaldi'))
+    monkeypatch.setattr(app_module, 'RAG_models', type(app_module.RAG_models)())
+
+    session_ids = [f"s{i}" for i in range(app_module.RAG_MODELS_MAX + 1)]
+    indexed = {}
+    for session_id in session_ids:
+        indexed[session_id], _ = build_index(str(tmp_path), session_id)
+        app_module.cache_rag_model(session_id, indexed[session_id])
+    assert session_ids[0] not in app_module.RAG_models
+
+    RAG = app_module.get_rag_model(session_ids[0])
+    assert RAG is not None
+    assert result_keys(RAG, 'scope') == result_keys(indexed[session_ids[0]], 'scope')
+    assert retriever.retrieve_documents(RAG, 'scope', session_ids[0])
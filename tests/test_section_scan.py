@@ -0,0 +1,51 @@
+# tests/test_section_scan.py
+
+import random
+import re
+
+import pytest
+
+from models import section_scan
+
+# Characters that exercise the heading rules, including whitespace and digits
+# that only str semantics recognize (NBSP, EM SPACE, NEL, 0x1c, Arabic-Indic three)
+ALPHABET = ['Section', 'Section ', '1', '2', '3', '.', ' ', '\t', '\r', '\n', '\n',
+            'a', 'x', 'é', '\xa0', ' ', '\x85', '\x1c', '٣']
+
+
+def parse_sections_baseline(text):
+    # The original per-line loop from app.parse_document
+    sections = {}
+    current_section = None
+    for line in text.split('\n'):
+        section_match = re.match(r'(Section\s+)?(\d+(\.\d+)*)', line.strip())
+        if section_match:
+            current_section = section_match.group(2)
+            sections[current_section] = ''
+        elif current_section:
+            sections[current_section] += line + '\n'
+    return sections
+
+
+def random_texts(count, seed=0):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40)))
+
+
+@pytest.mark.parametrize("parse", [section_scan.parse_sections, section_scan._parse_sections_regex])
+def test_nbsp_headings(parse):
+    text = 'Intro\nSection\xa02.1 Scope\nbody\n\xa03 Results\nmore\n'
+    assert parse(text) == parse_sections_baseline(text)
+    assert set(parse(text)) == {'2.1', '3'}
+
+
+def test_regex_parser_matches_baseline():
+    for text in random_texts(20000, seed=1):
+        assert section_scan._parse_sections_regex(text) == parse_sections_baseline(text), repr(text)
+
+
+@pytest.mark.skipif(not section_scan.NUMBA_AVAILABLE, reason="numba is not installed")
+def test_numba_scanner_matches_baseline():
+    for text in random_texts(20000):
+        assert section_scan.parse_sections(text) == parse_sections_baseline(text), repr(text)
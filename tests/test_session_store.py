@@ -0,0 +1,131 @@
+# tests/test_session_store.py
+
+import json
+import os
+
+import pytest
+
+from models.session_store import SessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    # Long interval: the tests control when the queue is flushed
+    store = SessionStore(str(tmp_path / 'sessions.db'), flush_interval=60)
+    yield store
+    store.close()
+
+
+def count_rows(store, table, session_id):
+    column = 'id' if table == 'sessions' else 'session_id'
+    return store._query(f"SELECT COUNT(*) FROM {table} WHERE {column} = ?", (session_id,))[0][0]
+
+
+def test_appended_messages_keep_order(store):
+    store.create_session('s1', 'First')
+    for i in range(50):
+        store.append_message('s1', 'user' if i % 2 == 0 else 'assistant', f"message {i}")
+    store.append_message('s1', 'assistant', 'with images', images=['images/s1/a.png'])
+
+    # Reads flush the queue first
+    session = store.get_session('s1')
+    assert [message['content'] for message in session['chat_history']] == \
+        [f"message {i}" for i in range(50)] + ['with images']
+    assert session['chat_history'][-1]['images'] == ['images/s1/a.png']
+    assert session['session_name'] == 'First'
+
+
+def test_failing_statement_keeps_rest_of_batch(store):
+    store.create_session('s1')
+    store.append_message('s1', 'user', 'before')
+    store._enqueue("INSERT INTO no_such_table VALUES (1)")
+    store.append_message('s1', 'user', 'after')
+    store.flush()
+
+    assert [message['content'] for message in store.get_session('s1')['chat_history']] == ['before', 'after']
+    assert store._pending == []
+
+
+def test_failed_commit_requeues_batch(store):
+    real_conn = store._conn
+
+    class FailingCommit:
+        # sqlite3.Connection attributes are read-only, so wrap it instead
+        def __getattr__(self, name):
+            return getattr(real_conn, name)
+
+        def execute(self, sql, *args):
+            if sql == "COMMIT":
+                raise OSError("disk I/O error")
+            return real_conn.execute(sql, *args)
+
+    store.create_session('s1')
+    store.append_message('s1', 'user', 'kept')
+    store._conn = FailingCommit()
+    with pytest.raises(OSError):
+        store.flush()
+    assert len(store._pending) == 3
+
+    store._conn = real_conn
+    assert [message['content'] for message in store.get_session('s1')['chat_history']] == ['kept']
+
+
+def test_import_json_sessions(store, tmp_path):
+    session_folder = tmp_path / 'sessions'
+    session_folder.mkdir()
+    legacy = {
+        'session_name': 'Legacy',
+        'index_version': 3,
+        'chat_history': [{'role': 'user', 'content': 'hi'},
+                         {'role': 'assistant', 'content': 'hello', 'images': ['images/old/a.png']}],
+        'indexed_files': ['a.pdf', 'b.pdf'],
+    }
+    (session_folder / 'old.json').write_text(json.dumps(legacy))
+
+    store.import_json_sessions(str(session_folder))
+    assert sorted(os.listdir(session_folder)) == ['old.json.imported']
+    session = store.get_session('old')
+    assert session['session_name'] == 'Legacy'
+    assert session['index_version'] == 3
+    assert session['chat_history'] == legacy['chat_history']
+    assert session['indexed_files'] == ['a.pdf', 'b.pdf']
+
+    # Deleted sessions are not imported again from the renamed file
+    store.delete_session('old')
+    store.import_json_sessions(str(session_folder))
+    assert store.get_session('old') is None
+
+
+def test_purge_deleted_sessions(store):
+    for session_id in ('kept', 'gone'):
+        store.create_session(session_id)
+        store.append_message(session_id, 'user', 'hi')
+        store.add_indexed_files(session_id, ['a.pdf'])
+        store.add_file_hash(session_id, f"hash-{session_id}", 'a.pdf')
+    store.delete_session('gone')
+    store.purge_deleted_sessions()
+
+    for table in ('sessions', 'messages', 'indexed_files', 'file_hashes'):
+        assert count_rows(store, table, 'gone') == 0, table
+        assert count_rows(store, table, 'kept') == 1, table
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_writes_after_fork(store):
+    store.create_session('s1')
+    store.start()
+    store.flush()
+    pid = os.fork()
+    if pid == 0:
+        # The child reopened the connection and starts its own flusher
+        try:
+            assert store._flusher is None
+            store.start()
+            store.append_message('s1', 'user', 'from child')
+            store.flush()
+            os._exit(0 if store._flusher.is_alive() else 1)
+        except BaseException:
+            os._exit(1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert [message['content'] for message in store.get_session('s1')['chat_history']] == ['from child']
@@ -0,0 +1,6 @@
+# wsgi.py
+
+from app import app
+
+if __name__ == '__main__':
+    app.run(port=5050)